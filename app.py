@@ -2,11 +2,113 @@ import streamlit as st
 import pandas as pd
 import portfolio_optimization as po
 import matplotlib.pyplot as plt
-import plotly.graph_objects as go
 import companies as co
+import optimizer_state as os_
+import instrumentation as ins
+
+
+##############################
+#        Cached stages       #
+##############################
+# Streamlit reruns this script at every widget change : every stage is cached on its own inputs only,
+# so changing a VaR parameter recomputes only the VaR, and changing the dates only reads the price store again
+# (which downloads only the missing dates).
+
+@st.cache_data(show_spinner="Loading the prices...")
+def loadReturns(tickers, start_date, end_date):
+    """Data stage : a ReturnsMatrix, which the other stages use without pandas"""
+    return po.getReturnsMatrix(list(tickers), start_date, end_date)
+
+
+@st.cache_data(show_spinner="Optimizing the portfolios...")
+def optimize(tickers, start_date, end_date, risk_free_rate, constraint_set, _state=None):
+    """Optimization stage.
+
+    With the optimizer state of the session (not part of the cache key), only the moments of the tickers added
+    since the last basket are computed, and the optimizers start from the previous weights"""
+    returns = loadReturns(tickers, start_date, end_date)
+    if _state is not None:
+        mean_returns, cov_matrix = _state.moments(returns, (start_date, end_date))
+        initial_guesses = (_state.initialGuess('Maximum Sharpe Ratio', tickers), _state.initialGuess('Minimum volatility', tickers))
+    else:
+        mean_returns, cov_matrix = returns.mean(), returns.cov()
+        initial_guesses = None
+    results = po.resultsTable(mean_returns, cov_matrix, list(tickers), risk_free_rate, constraint_set, initial_guesses)
+    calculated_results = po.calculatedResults(mean_returns, cov_matrix, risk_free_rate, constraint_set, initial_guesses=initial_guesses)
+    if _state is not None:
+        _state.remember('Maximum Sharpe Ratio', tickers, calculated_results[0]['x'])
+        _state.remember('Minimum volatility', tickers, calculated_results[4]['x'])
+    return results, calculated_results
+
+
+@st.cache_data(show_spinner="Computing the Values at Risk...")
+def valuesAtRisk(tickers, start_date, end_date, risk_free_rate, constraint_set, confidence_level, time_horizon, n_simulations):
+    """VaR stage"""
+    returns = loadReturns(tickers, start_date, end_date)
+    calculated_results = optimize(tickers, start_date, end_date, risk_free_rate, constraint_set)[1]
+    max_SR_weights, min_var_weights = calculated_results[0]['x'], calculated_results[4]['x']
+    index = ['Maximum Sharpe Ratio', 'Minimum volatility']
+    columns = ['Parametric VaR', 'Historical VaR', 'Monte Carlo VaR', 'Monte Carlo standard error']
+    var = pd.DataFrame(columns=columns, index=index)
+
+    # Every VaR in one pass : parametric and historical VaR over 1 day, Monte Carlo VaR over the time horizon
+    # with a fixed seed, the Monte Carlo VaR is the same at every run (for a given po.MAX_WORKERS)
+    var_table = po.varTable(returns, [max_SR_weights, min_var_weights], [confidence_level], [1, time_horizon], n_simulations, index,
+                            seed=0, max_workers=po.MAX_WORKERS)
+    for name in index:
+        var.loc[name, 'Parametric VaR'] = var_table.loc[(name, confidence_level, 1), 'Parametric VaR']
+        var.loc[name, 'Historical VaR'] = var_table.loc[(name, confidence_level, 1), 'Historical VaR']
+        var.loc[name, 'Monte Carlo VaR'] = var_table.loc[(name, confidence_level, time_horizon), 'Monte Carlo VaR']
+        var.loc[name, 'Monte Carlo standard error'] = var_table.loc[(name, confidence_level, time_horizon), 'Monte Carlo standard error']
+    return var
+
+
+@st.cache_data(show_spinner="Computing the rolling Values at Risk...")
+def rollingValuesAtRisk(tickers, start_date, end_date, risk_free_rate, constraint_set, confidence_level):
+    """VaR stage : 1 day historical VaR and Expected Shortfall over a sliding window of one year"""
+    returns = loadReturns(tickers, start_date, end_date)
+    calculated_results = optimize(tickers, start_date, end_date, risk_free_rate, constraint_set)[1]
+    weights = [calculated_results[0]['x'], calculated_results[4]['x']]
+    if len(returns) - 1 < po.N_TRADING_DAYS:
+        return None
+    rolling = po.rollingVar(returns, weights, [confidence_level], po.N_TRADING_DAYS, ['Maximum Sharpe Ratio', 'Minimum volatility'])
+    rolling.columns = [f'{name} ({measure})' for name, measure, level in rolling.columns]
+    return rolling
+
+
+@st.cache_data(show_spinner="Drawing random portfolios...")
+def randomCloud(tickers, start_date, end_date, risk_free_rate, constraint_set):
+    """Figures stage : cloud of random portfolios (downsampled to po.CLOUD_POINTS) under the efficient frontier"""
+    returns = loadReturns(tickers, start_date, end_date)
+    return po.randomPortfolios(returns.meanArray(), returns.covArray(), risk_free_rate, constraint_set, seed=0)
+
+
+# The figures are built again at every run from the cached stages (it is fast) : cached figures would be shared,
+# mutable objects between every session
+
+def pieCharts(tickers, start_date, end_date, risk_free_rate, constraint_set):
+    """Pie charts of the allocations (to close once displayed)"""
+    return po.pieChart(optimize(tickers, start_date, end_date, risk_free_rate, constraint_set)[0], list(tickers))
+
+
+def frontierGraph(tickers, start_date, end_date, risk_free_rate, constraint_set):
+    """Efficient frontier over the cloud of random portfolios"""
+    return po.efficientFrontierFigure(optimize(tickers, start_date, end_date, risk_free_rate, constraint_set)[1],
+                                      randomCloud(tickers, start_date, end_date, risk_free_rate, constraint_set))
+
 
 st.set_page_config(page_title="Portfolio Optimization")
 
+# Performance instrumentation of this run (the cached stages which are not recomputed do not appear),
+# in a Recorder of its own : the module one is shared by every session
+show_performance = st.sidebar.checkbox("Show performance")
+profile_run = st.sidebar.checkbox("Profile this run (cProfile)")
+recorder = ins.Recorder()
+ins.setRecorder(recorder)
+if profile_run:
+    profile = ins.Profile()
+    profile.start()
+
 st.title("Portfolio optimization")
 st.write("Using the Modern Portfolio theory")
 st.text("")
@@ -56,99 +158,60 @@ with col3:
 
 st.text("")
 
+# The optimization inputs are kept from the last click, so the results stay displayed (and cached) when
+# only the VaR parameters change afterwards
 if(st.button("Calculate the results")):
+    st.session_state['inputs'] = (tuple(tickers), start_date, end_date, risk_free_rate, constraint_set)
+
+if 'inputs' in st.session_state:
+    inputs = st.session_state['inputs']
+
     # Results table
     st.subheader("Results")
-    mean_returns, cov_matrix = po.getData(tickers, start_date, end_date)
-    results = po.resultsTable(mean_returns, cov_matrix, tickers, risk_free_rate, constraint_set)
+    if 'optimizer_state' not in st.session_state:
+        st.session_state['optimizer_state'] = os_.OptimizerState()
+    results = optimize(*inputs, _state=st.session_state['optimizer_state'])[0]
     st.table(results)
 
     # VaR results
     st.subheader("Values at Risk")
-    index = ['Maximum Sharpe Ratio', 'Minimum volatility']
-    columns = ['Parametric VaR', 'Historical VaR', 'Monte Carlo VaR']
-    var = pd.DataFrame(columns=columns, index=index)
-    max_SR_weights = po.maximumSharpeRatio(mean_returns, cov_matrix, risk_free_rate, constraint_set)['x']
-    min_var_weights = po.minimumVariance(mean_returns, cov_matrix, constraint_set)['x']
-    returns = po.getAllReturns(tickers, start_date, end_date)
-
-    # Max Sharpe Ratio
-    var.loc['Maximum Sharpe Ratio', 'Parametric VaR'] = parametric_var = po.parametricVar(returns, max_SR_weights, confidence_level)
-    var.loc['Maximum Sharpe Ratio', 'Historical VaR'] = historical_var = po.historicalVar(returns, max_SR_weights, confidence_level)
-    var.loc['Maximum Sharpe Ratio', 'Monte Carlo VaR'] = montecarlo_var =  po.monteCarloVar(returns, max_SR_weights, confidence_level, n_simulations, time_horizon)
-
-    #Min volatility
-    var.loc['Minimum volatility', 'Parametric VaR'] = parametric_var = po.parametricVar(returns, min_var_weights, confidence_level)
-    var.loc['Minimum volatility', 'Historical VaR'] = historical_var = po.historicalVar(returns, min_var_weights, confidence_level)
-    var.loc['Minimum volatility', 'Monte Carlo VaR'] = montecarlo_var =  po.monteCarloVar(returns, min_var_weights, confidence_level, n_simulations, time_horizon)
-    
-    st.table(var)
+    st.table(valuesAtRisk(*inputs, confidence_level, time_horizon, n_simulations))
+    rolling = rollingValuesAtRisk(*inputs, confidence_level)
+    if rolling is not None:
+        st.write("**Historical VaR and Expected Shortfall over the last year**")
+        st.line_chart(rolling)
 
     # Pie charts
-    labels = tickers
-    max_SR_sizes = results.loc['Maximum Sharpe Ratio', tickers]
-    min_vol_sizes = results.loc['Minimum volatility', tickers]
-
-    col1, col2 = st.columns(2)
-    with col1:
-        st.write("**Maximum Sharpe Ratio stock allocation**")
-        fig1, ax1 = plt.subplots()
-        ax1.pie(max_SR_sizes, labels=labels, autopct='%1.1f%%', startangle=90)
-        ax1.axis('equal')
-        st.pyplot(fig1)
-    with col2:
-        st.write("**Minimum volatility stock allocation**")
-        fig2, ax2 = plt.subplots()
-        ax2.pie(min_vol_sizes, labels=labels, autopct='%1.1f%%', startangle=90)
-        ax2.axis('equal')
-        st.pyplot(fig2)
-
-
-    # Efficient frontier
-    max_SR_results, max_SR_returns, max_SR_std, max_SR_allocation, min_volatility_results, min_volatility_returns, min_volatility_std, min_volatility_allocation, efficient_list, target_returns = po.calculatedResults(mean_returns, cov_matrix, risk_free_rate, constraint_set)
-
-    #Max SR
-    max_SR = go.Scatter(
-        name='Maximum Sharpe Ratio',
-        mode='markers',
-        x=[max_SR_std],
-        y=[max_SR_returns],
-        marker=dict(color='red', size=14, line=dict(width=3, color='black')))
-
-    # Min volatility
-    min_volatility = go.Scatter(
-        name='Minimum Volatility',
-        mode='markers',
-        x=[min_volatility_std],
-        y=[min_volatility_returns],
-        marker=dict(color='green', size=14, line=dict(width=3, color='black')))
+    with ins.stage('pie charts (matplotlib)'):
+        fig1, fig2 = pieCharts(*inputs)
+        col1, col2 = st.columns(2)
+        with col1:
+            st.write("**Maximum Sharpe Ratio stock allocation**")
+            st.pyplot(fig1)
+        with col2:
+            st.write("**Minimum volatility stock allocation**")
+            st.pyplot(fig2)
+        plt.close(fig1)
+        plt.close(fig2)
 
     # Efficient frontier
-    efficien_curve = go.Scatter(
-        name='Efficient Frontier',
-        mode='lines',
-        x=[round(ef_std*100,2) for ef_std in efficient_list],
-        y=[round(target*100,2) for target in target_returns],
-        line=dict(color='black', width=4, dash='dashdot'))
-
-    data = [max_SR, min_volatility, efficien_curve]
-
-    layout = go.Layout(
-        title = 'Portfolio optimization with Efficient Frontier',
-        yaxis = dict(title='Annualised Return (%)'),
-        xaxis= dict(title='Annualised volatility (%)'),
-        showlegend = True,
-        legend = dict(
-            x=0.75, y=0, traceorder='normal', # bottom right corner
-            bgcolor='#E2E2E2',
-            bordercolor='black',
-            borderwidth=2
-        ),
-        width=800,
-        height=600)
-    
-    efficient_graph = go.Figure(data=data, layout=layout)
-    st.plotly_chart(efficient_graph)
+    with ins.stage('efficient frontier (plotly)'):
+        st.plotly_chart(frontierGraph(*inputs))
 
 else:
-    st.write("Press the button to calculate the optimized Portfolio values")
\ No newline at end of file
+    st.write("Press the button to calculate the optimized Portfolio values")
+
+# Performance panel
+if profile_run:
+    profile.stop()
+if show_performance or profile_run:
+    st.subheader("Performance")
+    performance = pd.DataFrame.from_dict(recorder.report(), orient='index')
+    if len(performance):
+        st.dataframe(performance.drop(columns='shapes'))
+        st.download_button("Download the measures (JSON)", recorder.toJson(), file_name='performance.json')
+    else:
+        st.write("Nothing was computed during this run (every stage came from the cache)")
+    if profile_run:
+        with st.expander("Profile of this run"):
+            st.text(profile.summary())
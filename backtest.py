@@ -0,0 +1,99 @@
+##############################
+#          Libraries         #
+##############################
+
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+import portfolio_optimization as po
+
+
+##############################
+#         Parameters         #
+##############################
+
+WINDOW = po.N_TRADING_DAYS # estimation window (trading days)
+REBALANCE = 21 # trading days between two rebalances (about one month)
+
+
+##############################
+#       Rolling moments      #
+##############################
+
+class RollingMoments:
+    """Mean and covariance of a sliding window of daily returns, updated by rank-1 additions and removals (Welford)"""
+
+    def __init__(self, n_assets):
+        self.count = 0
+        self.mean = np.zeros(n_assets)
+        self.m2 = np.zeros((n_assets, n_assets)) # sum of the outer products of the deviations
+
+    def add(self, returns):
+        self.count += 1
+        delta = returns - self.mean
+        self.mean += delta/self.count
+        self.m2 += np.outer(delta, returns - self.mean)
+
+    def remove(self, returns):
+        if self.count == 1:
+            self.__init__(len(self.mean))
+            return
+        self.count -= 1
+        delta = returns - self.mean
+        self.mean -= delta/self.count
+        self.m2 -= np.outer(delta, returns - self.mean)
+
+    def cov(self):
+        """Sample covariance (same as returns.cov() on the window)"""
+        return self.m2/(self.count - 1)
+
+
+##############################
+#          Backtest          #
+##############################
+
+def backtest(returns, window=WINDOW, rebalance=REBALANCE, risk_free_rate=po.RISK_FREE_RATE, constraint_set=po.CONSTRAINT_SET, confidence_level=0.95):
+    """Re-optimize the maximum Sharpe ratio portfolio every rebalance days on the last window days.
+
+    returns is a DataFrame of daily returns (such as getAllReturns), the days with a missing return
+    are dropped. Each rebalance updates the window moments with the days which entered and left it,
+    and starts the optimizer from the previous weights.
+    Returns the table of the rebalances (realized return until the next rebalance, turnover, VaR of the
+    window, optimizer evaluations), the weights of every rebalance and the daily portfolio returns."""
+    returns = returns.dropna()
+    values = np.ascontiguousarray(returns.values, dtype=float)
+    n_days, n_assets = values.shape
+    if n_days <= window:
+        raise ValueError(f"{n_days} days of returns, more than the window ({window} days) are needed")
+    solve = po.maximumSharpeRatio.__wrapped__ # every window is a new problem, no need to fill the result cache
+
+    moments = RollingMoments(n_assets)
+    for day in range(window):
+        moments.add(values[day])
+    weights = None
+    rows, allocations, daily = [], [], []
+    for start in range(window, n_days, rebalance):
+        if start > window: # slide the window over the days since the last rebalance
+            for day in range(start - rebalance, start):
+                moments.remove(values[day - window])
+                moments.add(values[day])
+
+        result = solve(moments.mean, moments.cov(), risk_free_rate, constraint_set, weights)
+        turnover = np.sum(np.abs(result['x'] - weights)) if weights is not None else np.sum(np.abs(result['x']))
+        weights = result['x']
+
+        window_returns = np.dot(values[start - window:start], weights)
+        held_returns = np.dot(values[start:start + rebalance], weights)
+        daily.append(pd.Series(held_returns, index=returns.index[start:start + rebalance]))
+        allocations.append(weights)
+        rows.append({
+            'Realized return': np.prod(1 + held_returns) - 1,
+            'Turnover': turnover,
+            'Parametric VaR': np.dot(weights, moments.mean) + norm.ppf(1 - confidence_level)*np.sqrt(np.dot(weights, np.dot(moments.cov(), weights))),
+            'Historical VaR': np.percentile(window_returns, 100 - confidence_level*100),
+            'Function evaluations': result['nfev'],
+        })
+    dates = returns.index[window:n_days:rebalance]
+    results = pd.DataFrame(rows, index=dates)
+    allocations = pd.DataFrame(allocations, index=dates, columns=returns.columns)
+    return results, allocations, pd.concat(daily)
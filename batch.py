@@ -0,0 +1,142 @@
+"""Headless batch runs of portfolio scenarios, without Streamlit.
+
+    python batch.py scenarios.json --output results --format csv --workers 4
+
+The scenario file is a JSON list of scenarios (or {"defaults": {...}, "scenarios": [...]}), such as :
+
+    {"name": "tech", "tickers": ["AAPL", "MSFT", "NVDA"], "start": "2020-01-01", "end": "2024-01-01",
+     "risk_free_rate": 0.015, "constraint_set": [0, 0.5]}
+
+A scenario can list "sectors" of companies.py instead of (or on top of) "tickers". The other keys are
+optional : "cov_estimator", "frontier_points", "confidence_levels", "time_horizons", "num_simulations", "seed".
+The prices are loaded once for the union of the tickers, and every scenario uses a slice of them.
+Four tables are written in the output folder : results, weights, frontier and var.
+"""
+
+##############################
+#          Libraries         #
+##############################
+
+import os
+import sys
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import portfolio_optimization as po
+import covariance as cv
+import returns_matrix as rm
+import companies as co
+
+
+##############################
+#         Parameters         #
+##############################
+
+DEFAULTS = {
+    'start': po.START_DATE,
+    'end': None, # today
+    'risk_free_rate': po.RISK_FREE_RATE,
+    'constraint_set': po.CONSTRAINT_SET,
+    'cov_estimator': po.COV_ESTIMATOR,
+    'frontier_points': po.FRONTIER_POINTS,
+    'confidence_levels': [0.90, 0.95, 0.99],
+    'time_horizons': [1, 10, 252],
+    'num_simulations': po.N_SIMULATIONS,
+    'seed': 0,
+}
+TABLES = ['results', 'weights', 'frontier', 'var']
+
+
+##############################
+#          Scenarios         #
+##############################
+
+def loadScenarios(path):
+    """Read a scenario file and complete every scenario with the defaults"""
+    with open(path) as file:
+        content = json.load(file)
+    if isinstance(content, dict):
+        defaults, scenarios = {**DEFAULTS, **content.get('defaults', {})}, content['scenarios']
+    else:
+        defaults, scenarios = dict(DEFAULTS), content
+    completed = []
+    for i, scenario in enumerate(scenarios):
+        scenario = {**defaults, 'name': f'scenario_{i}', **scenario}
+        tickers = list(scenario.get('tickers', []))
+        for sector in scenario.get('sectors', []):
+            tickers += list(co.companies[sector].values())
+        scenario['tickers'] = list(dict.fromkeys(tickers))
+        if len(scenario['tickers']) < 2:
+            raise ValueError(f"Scenario {scenario['name']!r} needs at least 2 tickers")
+        scenario['end'] = scenario['end'] or po.END_DATE.strftime('%Y-%m-%d')
+        scenario['constraint_set'] = tuple(scenario['constraint_set'])
+        completed.append(scenario)
+    return completed
+
+
+def runScenario(scenario, prices):
+    """Optimize one scenario from its slice of the prices, and return its rows of the 4 tables"""
+    prices = prices.dropna(how='all')
+    returns = rm.ReturnsMatrix.fromFrame(prices.pct_change())
+    mean_returns = returns.mean()
+    cov_matrix = cv.estimateCovariance(returns, scenario['cov_estimator'])
+    risk_free_rate, constraint_set = scenario['risk_free_rate'], scenario['constraint_set']
+    (max_SR_results, max_SR_returns, max_SR_std, max_SR_allocation, min_volatility_results, min_volatility_returns,
+     min_volatility_std, min_volatility_allocation, efficient_list, target_returns) = po.calculatedResults(
+        mean_returns, cov_matrix, risk_free_rate, constraint_set, scenario['frontier_points'])
+
+    name = scenario['name']
+    portfolios = {'Maximum Sharpe Ratio': max_SR_results['x'], 'Minimum volatility': min_volatility_results['x']}
+    results, weights = [], []
+    for portfolio, x in portfolios.items():
+        portfolio_returns, portfolio_std = po.portfolioPerformance(x, mean_returns.values, cv.asCovariance(cov_matrix))
+        results.append({'Scenario': name, 'Portfolio': portfolio, 'Sharpe Ratio': (portfolio_returns - risk_free_rate)/portfolio_std,
+                        'Returns (%)': portfolio_returns*100, 'Volatility (%)': portfolio_std*100})
+        weights += [{'Scenario': name, 'Portfolio': portfolio, 'Ticker': ticker, 'Weight': weight}
+                    for ticker, weight in zip(mean_returns.index, x)]
+    frontier = pd.DataFrame({'Scenario': name, 'Target return (%)': np.asarray(target_returns)*100,
+                             'Volatility (%)': np.asarray(efficient_list)*100})
+    var = po.varTable(returns, list(portfolios.values()), scenario['confidence_levels'], scenario['time_horizons'],
+                      scenario['num_simulations'], list(portfolios), scenario['seed']).reset_index()
+    var.insert(0, 'Scenario', name)
+    return {'results': pd.DataFrame(results), 'weights': pd.DataFrame(weights), 'frontier': frontier, 'var': var}
+
+
+def runBatch(scenarios, max_workers=1):
+    """Load the prices once for all the scenarios, run them (on max_workers processes) and concatenate their tables"""
+    tickers = list(dict.fromkeys(ticker for scenario in scenarios for ticker in scenario['tickers']))
+    start = min(pd.Timestamp(scenario['start']) for scenario in scenarios)
+    end = max(pd.Timestamp(scenario['end']) for scenario in scenarios)
+    prices = po.priceStore().getPrices(tickers, start, end)
+    slices = [prices.loc[(prices.index >= scenario['start']) & (prices.index < scenario['end']), scenario['tickers']]
+              for scenario in scenarios]
+
+    if max_workers > 1:
+        with ProcessPoolExecutor(max_workers) as executor:
+            outputs = list(executor.map(runScenario, scenarios, slices))
+    else:
+        outputs = [runScenario(scenario, prices) for scenario, prices in zip(scenarios, slices)]
+    return {table: pd.concat([output[table] for output in outputs], ignore_index=True) for table in TABLES}
+
+
+def writeTables(tables, folder, format='csv'):
+    os.makedirs(folder, exist_ok=True)
+    for name, table in tables.items():
+        path = os.path.join(folder, f'{name}.{format}')
+        if format == 'parquet':
+            table.to_parquet(path, index=False)
+        else:
+            table.to_csv(path, index=False)
+        print(f'{path} : {len(table)} rows', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', help='JSON scenario file')
+    parser.add_argument('--output', default='results', help='output folder (default : results)')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes (default : 1)')
+    args = parser.parse_args()
+    writeTables(runBatch(loadScenarios(args.scenarios), args.workers), args.output, args.format)
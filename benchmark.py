@@ -0,0 +1,207 @@
+"""Benchmark of portfolio_optimization on synthetic prices (no network).
+
+Times the data preprocessing, the optimizers, the efficient frontier and the VaR functions
+for several universe sizes and history lengths, and writes the results as JSON :
+
+    python benchmark.py --output bench.json
+    python benchmark.py --output new.json --compare bench.json
+    python benchmark.py --imports   (check the import time budget of portfolio_optimization only)
+"""
+
+##############################
+#          Libraries         #
+##############################
+
+import sys
+import os
+import json
+import time
+import subprocess
+import zlib
+import argparse
+import tempfile
+import platform
+import tracemalloc
+import numpy as np
+import pandas as pd
+import scipy
+import portfolio_optimization as po
+import price_store as ps
+
+
+##############################
+#         Parameters         #
+##############################
+
+SIZES = [5, 20, 50, len(po.TICKERS)]
+HISTORIES = [252, 756, 1260] # number of trading days
+REPEAT = 3
+ORIGIN = '2000-01-03' # first day of the synthetic prices
+IMPORT_BUDGET = 0.3 # seconds to import portfolio_optimization (NumPy included)
+HEAVY_MODULES = ['scipy', 'pandas', 'yfinance', 'plotly', 'matplotlib'] # must not be imported with portfolio_optimization
+
+
+##############################
+#       Synthetic data       #
+##############################
+
+class SyntheticSource:
+    """Deterministic random-walk prices : the price of a ticker on a day does not depend on the requested range"""
+
+    def __init__(self):
+        self.histories = {}
+
+    def _history(self, ticker, end):
+        if ticker not in self.histories or self.histories[ticker].index[-1] < end:
+            dates = pd.bdate_range(ORIGIN, end)
+            rng = np.random.default_rng(zlib.crc32(ticker.encode()))
+            market = np.random.default_rng(0).normal(0.0003, 0.01, len(dates))
+            returns = rng.uniform(0.5, 1.5)*market + rng.normal(0.0002, 0.015, len(dates))
+            self.histories[ticker] = pd.Series(100*np.cumprod(1 + returns), index=dates)
+        return self.histories[ticker]
+
+    def fetch(self, tickers, start, end):
+        data = {}
+        for ticker in tickers:
+            history = self._history(ticker, pd.Timestamp(end))
+            dates = history.index.values.astype('datetime64[D]')
+            data[ticker] = history[(dates >= start) & (dates < end)]
+        return pd.DataFrame(data)
+
+
+##############################
+#          Measures          #
+##############################
+
+class EvaluationCounter:
+    """Count the calls of the optimizer objectives of portfolio_optimization"""
+
+    def __init__(self, names=('negSharpeRatio', 'portfolioVariance')):
+        self.names = names
+        self.count = 0
+
+    def __enter__(self):
+        self.originals = {name: getattr(po, name) for name in self.names}
+        for name, function in self.originals.items():
+            setattr(po, name, self._counted(function))
+        return self
+
+    def __exit__(self, *exc):
+        for name, function in self.originals.items():
+            setattr(po, name, function)
+
+    def _counted(self, function):
+        def counted(*args):
+            self.count += 1
+            return function(*args)
+        return counted
+
+
+def measure(function, repeat):
+    """Best wall time over repeat runs, objective evaluations and peak traced memory of one run.
+
+    One untimed call comes first, so that no timing includes the lazy imports (SciPy...) of the 1st call"""
+    po.RESULT_CACHE.clear()
+    function()
+    times = []
+    for i in range(repeat):
+        po.RESULT_CACHE.clear()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    po.RESULT_CACHE.clear()
+    with EvaluationCounter() as counter:
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {'wall_time': min(times), 'function_evaluations': counter.count, 'peak_memory_mb': round(peak/2**20, 3)}
+
+
+def run(sizes, histories, repeat):
+    tickers = list(dict.fromkeys(po.TICKERS))
+    results = []
+    source = SyntheticSource()
+    for n_days in histories:
+        end = pd.bdate_range(ORIGIN, periods=n_days + 1)[-1] + pd.offsets.BDay()
+        for size in sizes:
+            stocks = tickers[:size]
+            with tempfile.TemporaryDirectory() as root: # a new empty store for every measure
+                po.PRICE_STORE = ps.PriceStore(root, source)
+                start = time.perf_counter()
+                mean_returns, cov_matrix = po.getData(stocks, ORIGIN, end)
+                cold = time.perf_counter() - start
+                returns = po.getAllReturns(stocks, ORIGIN, end)
+                weights = np.full(len(stocks), 1/len(stocks))
+
+                functions = {
+                    'getData': lambda: po.getData(stocks, ORIGIN, end),
+                    'maximumSharpeRatio': lambda: po.maximumSharpeRatio(mean_returns, cov_matrix, po.RISK_FREE_RATE, po.CONSTRAINT_SET),
+                    'minimumVariance': lambda: po.minimumVariance(mean_returns, cov_matrix, po.CONSTRAINT_SET),
+                    'calculatedResults': lambda: po.calculatedResults(mean_returns, cov_matrix, po.RISK_FREE_RATE, po.CONSTRAINT_SET),
+                    'parametricVar': lambda: po.parametricVar(returns, weights, 0.95),
+                    'historicalVar': lambda: po.historicalVar(returns, weights, 0.95),
+                    'monteCarloVar': lambda: po.monteCarloVar(returns, weights, 0.95, po.N_SIMULATIONS, po.N_TRADING_DAYS, seed=0),
+                }
+                results.append({'function': 'getData (empty store)', 'n_assets': len(stocks), 'n_days': n_days,
+                                'wall_time': cold, 'function_evaluations': 0, 'peak_memory_mb': None})
+                for name, function in functions.items():
+                    results.append({'function': name, 'n_assets': len(stocks), 'n_days': n_days, **measure(function, repeat)})
+                    print(f"{name:<24} N={len(stocks):<4} days={n_days:<5} {results[-1]['wall_time']:.4f} s", file=sys.stderr)
+    return results
+
+
+def importTime(repeat=REPEAT):
+    """Best time to import portfolio_optimization in a new interpreter, and the heavy modules it imported"""
+    code = ("import sys, time, json; start = time.perf_counter(); import portfolio_optimization; "
+            "print(json.dumps([time.perf_counter() - start, [m for m in %r if m in sys.modules]]))" % HEAVY_MODULES)
+    folder = os.path.dirname(os.path.abspath(__file__))
+    runs = [json.loads(subprocess.run([sys.executable, '-c', code], cwd=folder, capture_output=True, text=True, check=True).stdout)
+            for i in range(repeat)]
+    wall_time = min(run[0] for run in runs)
+    heavy_modules = runs[0][1]
+    return {'wall_time': wall_time, 'budget': IMPORT_BUDGET, 'heavy_modules': heavy_modules,
+            'within_budget': wall_time <= IMPORT_BUDGET and not heavy_modules}
+
+
+def compare(results, reference):
+    """Print the ratio of the wall times to a previous benchmark"""
+    previous = {(r['function'], r['n_assets'], r['n_days']): r for r in reference['results']}
+    for result in results:
+        key = (result['function'], result['n_assets'], result['n_days'])
+        if key in previous and previous[key]['wall_time'] > 0:
+            ratio = result['wall_time']/previous[key]['wall_time']
+            slower = ratio > 1.2 and result['wall_time'] - previous[key]['wall_time'] > 1e-3 # ignore the noise of tiny timings
+            flag = '  <-- slower' if slower else ''
+            print(f"{key[0]:<24} N={key[1]:<4} days={key[2]:<5} x{ratio:.2f}{flag}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='numbers of assets')
+    parser.add_argument('--days', type=int, nargs='+', default=HISTORIES, help='history lengths (trading days)')
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='timed runs per measure (the best one is kept)')
+    parser.add_argument('--output', help='JSON file to write (default : standard output)')
+    parser.add_argument('--compare', help='previous JSON benchmark to compare with')
+    parser.add_argument('--imports', action='store_true', help='only check the import time budget')
+    args = parser.parse_args()
+
+    imports = importTime(args.repeat)
+    if args.imports:
+        print(json.dumps(imports, indent=1))
+        sys.exit(0 if imports['within_budget'] else 1)
+
+    report = {
+        'meta': {'python': platform.python_version(), 'numpy': np.__version__, 'scipy': scipy.__version__,
+                 'pandas': pd.__version__, 'machine': platform.machine(), 'date': time.strftime('%Y-%m-%d %H:%M:%S')},
+        'import': imports,
+        'results': run(args.sizes, args.days, args.repeat),
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=1)
+    else:
+        print(json.dumps(report, indent=1))
+    if args.compare:
+        with open(args.compare) as file:
+            compare(report['results'], json.load(file))
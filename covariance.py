@@ -0,0 +1,162 @@
+##############################
+#          Libraries         #
+##############################
+
+import numpy as np
+
+
+##############################
+#         Parameters         #
+##############################
+
+PCA_FACTORS = 5
+MIN_SPECIFIC_VARIANCE = 1e-12
+
+
+##############################
+#    Factor covariance       #
+##############################
+
+class FactorCovariance:
+    """Covariance stored as loadings . factor_cov . loadings^T + diag(specific).
+
+    With N assets and k factors, a product with a weights vector costs O(N.k) instead of O(N^2)."""
+
+    def __init__(self, loadings, factor_cov, specific, index=None):
+        self.loadings = np.asarray(loadings, dtype=float) # N x k
+        self.factor_cov = np.asarray(factor_cov, dtype=float) # k x k
+        self.specific = np.asarray(specific, dtype=float) # N
+        self.index = index
+        self.shape = (len(self.specific), len(self.specific))
+
+    def __len__(self):
+        return len(self.specific)
+
+    def dot(self, weights):
+        """Product with a weights vector (N,) or with one weights vector per column (N, P)"""
+        weights = np.asarray(weights, dtype=float)
+        specific = self.specific if weights.ndim == 1 else self.specific[:, None]
+        return np.dot(self.loadings, np.dot(self.factor_cov, np.dot(self.loadings.T, weights))) + specific*weights
+
+    def sqrtTransposeDot(self, weights):
+        """L^T . weights for the factor L = [loadings.chol(factor_cov), diag(sqrt(specific))], whose L.L^T is the covariance"""
+        weights = np.asarray(weights, dtype=float)
+        factor_root = np.linalg.cholesky(self.factor_cov)
+        specific = np.sqrt(self.specific) if weights.ndim == 1 else np.sqrt(self.specific)[:, None]
+        return np.concatenate([np.dot(factor_root.T, np.dot(self.loadings.T, weights)), specific*weights])
+
+    def toDense(self):
+        return np.dot(self.loadings, np.dot(self.factor_cov, self.loadings.T)) + np.diag(self.specific)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.toDense() if dtype is None else self.toDense().astype(dtype)
+
+    def components(self):
+        return {'loadings': self.loadings, 'factor_cov': self.factor_cov, 'specific': self.specific}
+
+
+def covDot(cov_matrix, weights):
+    """cov_matrix . weights, for a dense covariance or a FactorCovariance"""
+    if isinstance(cov_matrix, FactorCovariance):
+        return cov_matrix.dot(weights)
+    return np.dot(cov_matrix, weights)
+
+
+def asCovariance(cov_matrix):
+    """Raw ndarray of a dense covariance, or the FactorCovariance itself"""
+    if isinstance(cov_matrix, FactorCovariance):
+        return cov_matrix
+    return np.asarray(cov_matrix, dtype=float)
+
+
+##############################
+#         Estimators         #
+##############################
+
+def _completeReturns(returns):
+    """Returns matrix without the days where a return is missing (such as the 1st one), centered"""
+    returns = returns.dropna()
+    values = returns.values
+    return values - values.mean(axis=0), returns.columns
+
+
+def sampleCovariance(returns):
+    """Sample covariance (pairwise complete days)"""
+    return returns.cov()
+
+
+def ledoitWolf(returns):
+    """Ledoit-Wolf shrinkage of the sample covariance towards a scaled identity"""
+    import pandas as pd
+    centered, tickers = _completeReturns(returns)
+    n_days, n_assets = centered.shape
+    sample = np.dot(centered.T, centered)/n_days
+    mu = np.trace(sample)/n_assets
+    # distance of the sample covariance to the target, and estimation error of the sample covariance
+    delta = np.sum((sample - mu*np.eye(n_assets))**2)/n_assets
+    squared = centered**2
+    beta = (np.sum(np.dot(squared.T, squared))/n_days - np.sum(sample**2))/(n_assets*n_days)
+    shrinkage = 0. if delta == 0 else min(beta, delta)/delta
+    sample = sample*n_days/(n_days - 1) # same scale as returns.cov()
+    mu = np.trace(sample)/n_assets
+    shrunk = (1 - shrinkage)*sample + shrinkage*mu*np.eye(n_assets)
+    return pd.DataFrame(shrunk, index=tickers, columns=tickers)
+
+
+def sectorMembership(tickers, sectors=None):
+    """Sector names and (sectors x tickers) membership matrix of the tickers.
+
+    sectors maps a ticker to its sector (default : the sectors of companies.py); unknown tickers form their own sector."""
+    if sectors is None:
+        import companies as co
+        sectors = {ticker: sector for sector, names in co.companies.items() for ticker in names.values()}
+    names = [sectors.get(ticker, ticker) for ticker in tickers]
+    sector_names = list(dict.fromkeys(names))
+    membership = np.zeros((len(sector_names), len(tickers)))
+    membership[[sector_names.index(name) for name in names], np.arange(len(tickers))] = 1
+    return sector_names, membership
+
+
+def sectorFactorModel(returns, sectors=None):
+    """One factor per sector of sectorMembership (equal-weighted return of its stocks), each stock loading only on its own sector"""
+    centered, tickers = _completeReturns(returns)
+    membership = sectorMembership(tickers, sectors)[1].T # stocks x factors
+    factor_returns = np.dot(centered, membership/membership.sum(axis=0)) # days x factors
+
+    n_days = len(centered)
+    factor_cov = np.dot(factor_returns.T, factor_returns)/(n_days - 1)
+    own_factor = np.dot(factor_returns, membership.T) # days x stocks : return of the sector of each stock
+    variances = np.sum(own_factor**2, axis=0)
+    betas = np.divide(np.sum(centered*own_factor, axis=0), variances, out=np.zeros(len(tickers)), where=variances > 0)
+    residuals = centered - own_factor*betas
+    specific = np.maximum(np.sum(residuals**2, axis=0)/(n_days - 1), MIN_SPECIFIC_VARIANCE)
+    return FactorCovariance(membership*betas[:, None], factor_cov, specific, tickers)
+
+
+def pcaFactorModel(returns, n_factors=PCA_FACTORS):
+    """Statistical factor model : the n_factors main principal components of the sample covariance"""
+    centered, tickers = _completeReturns(returns)
+    sample = np.dot(centered.T, centered)/(len(centered) - 1)
+    values, vectors = np.linalg.eigh(sample) # ascending eigenvalues
+    n_factors = min(n_factors, len(values))
+    values, vectors = values[::-1][:n_factors], vectors[:, ::-1][:, :n_factors]
+    loadings = vectors*np.sqrt(np.clip(values, 0, None))
+    specific = np.maximum(np.diag(sample) - np.sum(loadings**2, axis=1), MIN_SPECIFIC_VARIANCE)
+    return FactorCovariance(loadings, np.eye(n_factors), specific, tickers)
+
+
+ESTIMATORS = {
+    'sample': sampleCovariance,
+    'ledoitWolf': ledoitWolf,
+    'sector': sectorFactorModel,
+    'pca': pcaFactorModel,
+}
+
+
+def estimateCovariance(returns, estimator='sample'):
+    """Covariance of the returns with an estimator name of ESTIMATORS, or any function of the returns"""
+    if callable(estimator):
+        return estimator(returns)
+    if estimator not in ESTIMATORS:
+        raise ValueError(f"Unknown covariance estimator {estimator!r}, choose one of {list(ESTIMATORS)}")
+    return ESTIMATORS[estimator](returns)
@@ -0,0 +1,150 @@
+##############################
+#          Libraries         #
+##############################
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import portfolio_optimization as po
+import covariance as cv
+
+
+##############################
+#           Sectors          #
+##############################
+
+sectorMembership = cv.sectorMembership # the same sectors as the sector factor model
+
+
+def sectorCaps(membership, caps):
+    """Inequality (membership, caps) of maximumSharpeRatio and minimumVariance : the weight of every sector <= its cap.
+
+    caps is one number for every sector, or one cap per sector"""
+    return membership, np.broadcast_to(np.asarray(caps, dtype=float), len(membership)).copy()
+
+
+def _subProblem(mean_returns, cov_matrix, positions):
+    """Mean returns and covariance (dense or factor model) of some of the assets"""
+    mean_returns = np.asarray(mean_returns, dtype=float)[positions]
+    if isinstance(cov_matrix, cv.FactorCovariance):
+        return mean_returns, cv.FactorCovariance(cov_matrix.loadings[positions], cov_matrix.factor_cov, cov_matrix.specific[positions])
+    return mean_returns, np.asarray(cov_matrix, dtype=float)[np.ix_(positions, positions)]
+
+
+def _optimize(mean_returns, cov_matrix, risk_free_rate, constraint_set, objective):
+    """One optimization of a block (run in the workers) : every block is a new problem, the result cache is not used"""
+    if len(mean_returns) == 1:
+        from scipy.optimize import OptimizeResult
+        return OptimizeResult(x=np.ones(1), nit=0, nfev=0, success=True)
+    if objective == 'sharpe':
+        return po.maximumSharpeRatio.__wrapped__(mean_returns, cov_matrix, risk_free_rate, constraint_set)
+    return po.minimumVariance.__wrapped__(mean_returns, cov_matrix, constraint_set)
+
+
+##############################
+# Hierarchical optimization  #
+##############################
+
+def hierarchicalOptimization(mean_returns, cov_matrix, risk_free_rate, constraint_set, objective='sharpe', sectors=None,
+                             sector_caps=None, max_workers=None, executor='process'):
+    """Optimize every sector on its own (in parallel with max_workers), then the weights of the sector sub-portfolios.
+
+    objective is 'sharpe' (maximum Sharpe ratio) or 'variance' (minimum variance), at both levels. The sector
+    problems are small and independent, so the whole companies.py universe is solved as ~10 problems of ~15
+    assets and one of ~10 sectors, instead of one dense problem of ~130 assets.
+    Both bounds of constraint_set (the same (min, max) for every asset) are kept for every asset weight :
+    - min : every sector weight has a floor a.n.min (n assets in the sector, a = 1/sqrt(N.min) >= 1), and the
+      weights inside the sector are at least min/floor, so that sector weight x inner weight >= min
+    - max : the weights inside the sector are at most max/floor, and the sector weight is capped at
+      max / (largest weight inside the sector), along with the optional sector_caps (one number, or one per sector)
+    A ValueError is raised if sector_caps are below the floors, and success is False if a solve failed or if
+    the final weights are not within constraint_set. Returns an OptimizeResult with the asset weights x, the sector names and the sector weights."""
+    from scipy.optimize import OptimizeResult
+    tickers = list(getattr(mean_returns, 'index', range(len(mean_returns))))
+    sector_names, membership = sectorMembership(tickers, sectors)
+    blocks = [np.flatnonzero(row) for row in membership]
+    lower, upper = constraint_set
+    if len(tickers)*lower > 1 or len(tickers)*upper < 1:
+        raise ValueError(f"No portfolio of {len(tickers)} assets has its weights within {constraint_set}")
+    sizes = membership.sum(axis=1)
+    floors = sizes*lower/np.sqrt(len(tickers)*lower) if lower > 0 else np.zeros(len(blocks)) # a.n.min
+    problems = [_subProblem(mean_returns, cov_matrix, positions) for positions in blocks]
+    arguments = [(mean, cov, risk_free_rate, (lower/floor, min(1, upper/floor)) if floor > 0 else (0, 1), objective)
+                 for (mean, cov), floor in zip(problems, floors)]
+
+    if max_workers is not None and max_workers > 1:
+        Executor = ProcessPoolExecutor if executor == 'process' else ThreadPoolExecutor
+        with Executor(max_workers) as pool:
+            sector_results = list(pool.map(_optimize, *zip(*arguments)))
+    else:
+        sector_results = [_optimize(*args) for args in arguments]
+
+    # one column per sector sub-portfolio
+    loadings = np.zeros((len(tickers), len(blocks)))
+    for s, (positions, result) in enumerate(zip(blocks, sector_results)):
+        loadings[positions, s] = result['x']
+    sector_mean = np.dot(loadings.T, np.asarray(mean_returns, dtype=float))
+    sector_cov = np.dot(loadings.T, cv.covDot(cv.asCovariance(cov_matrix), loadings))
+    sector_upper = np.minimum(1, upper/loadings.max(axis=0))
+    if sector_caps is not None:
+        sector_upper = np.minimum(sector_upper, sector_caps)
+        if np.any(sector_upper < floors):
+            raise ValueError(f"sector_caps are below the sector floors {np.round(floors, 4)} required by the minimum weight {lower}")
+    sector_result = _optimize(sector_mean, sector_cov, risk_free_rate, np.column_stack([floors, sector_upper]), objective)
+
+    weights = np.dot(loadings, sector_result['x'])
+    returns, std = po.portfolioPerformance(weights, np.asarray(mean_returns, dtype=float), cv.asCovariance(cov_matrix))
+    tolerance = 1e-6
+    within_bounds = weights.min() >= lower - tolerance and weights.max() <= upper + tolerance
+    return OptimizeResult(x=weights, fun=-(returns - risk_free_rate)/std if objective == 'sharpe' else std,
+                          sectors=sector_names, sector_weights=sector_result['x'],
+                          nit=sum(result['nit'] for result in sector_results) + sector_result['nit'],
+                          nfev=sum(result['nfev'] for result in sector_results) + sector_result['nfev'],
+                          success=all(result['success'] for result in sector_results) and sector_result['success'] and within_bounds)
+
+
+##############################
+#  Hierarchical risk parity  #
+##############################
+
+def _clusterVariance(cov_matrix, positions):
+    """Variance of the inverse-variance portfolio of a cluster of assets"""
+    cov = np.asarray(_subProblem(np.zeros(len(cov_matrix)), cov_matrix, positions)[1])
+    inverse = 1/np.diag(cov)
+    weights = inverse/inverse.sum()
+    return np.dot(weights, np.dot(cov, weights))
+
+
+def _bisect(cov_matrix, node, weights, allocation):
+    """Split the allocation of a node of the tree between its two halves, inversely to their cluster variances"""
+    if isinstance(node, (int, np.integer)):
+        weights[node] = allocation
+        return
+    if len(node) == 1:
+        _bisect(cov_matrix, node[0], weights, allocation)
+        return
+    halves = node[:len(node)//2], node[len(node)//2:]
+    variances = [_clusterVariance(cov_matrix, np.array(_leaves(half))) for half in halves]
+    alpha = 1 - variances[0]/(variances[0] + variances[1])
+    _bisect(cov_matrix, halves[0], weights, allocation*alpha)
+    _bisect(cov_matrix, halves[1], weights, allocation*(1 - alpha))
+
+
+def _leaves(node):
+    if isinstance(node, (int, np.integer)):
+        return [node]
+    return [leaf for child in node for leaf in _leaves(child)]
+
+
+def hierarchicalRiskParity(cov_matrix, tickers=None, sectors=None):
+    """Hierarchical risk parity on the sector tree : recursive bisection of the sectors, then of the assets of each sector.
+
+    No optimizer is run (O(N^2) at most), and every covariance is inverted only on its diagonal.
+    The weights are long-only and sum to 1, constraint_set is not applied."""
+    if tickers is None:
+        index = getattr(cov_matrix, 'index', None)
+        tickers = list(range(len(cov_matrix)) if index is None else index)
+    sector_names, membership = sectorMembership(tickers, sectors)
+    tree = [list(np.flatnonzero(row)) for row in membership]
+    weights = np.zeros(len(tickers))
+    _bisect(cv.asCovariance(cov_matrix), tree, weights, 1.)
+    return weights
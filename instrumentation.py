@@ -0,0 +1,168 @@
+##############################
+#          Libraries         #
+##############################
+
+import io
+import json
+import time
+import logging
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+
+##############################
+#         Parameters         #
+##############################
+
+ENABLED = True
+LOGGER = logging.getLogger('portfolio_optimization.performance') # one JSON record per call, at DEBUG level
+
+
+##############################
+#          Recorder          #
+##############################
+
+class Recorder:
+    """Per-function (or per-stage) statistics : calls, wall time, optimizer iterations and evaluations, array sizes.
+
+    record() may be called from the threads of a thread Pool"""
+
+    def __init__(self):
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+    def record(self, name, wall_time, nit=0, nfev=0, shapes=None):
+        with self.lock:
+            stats = self.stats.setdefault(name, {'calls': 0, 'wall_time': 0., 'max_wall_time': 0., 'nit': 0, 'nfev': 0, 'shapes': []})
+            stats['calls'] += 1
+            stats['wall_time'] += wall_time
+            stats['max_wall_time'] = max(stats['max_wall_time'], wall_time)
+            stats['nit'] += nit
+            stats['nfev'] += nfev
+            if shapes:
+                stats['shapes'] = shapes # of the last call
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug(json.dumps({'name': name, 'wall_time': wall_time, 'nit': nit, 'nfev': nfev, 'shapes': shapes}))
+
+    def report(self):
+        """Statistics sorted by decreasing total wall time"""
+        return dict(sorted(self.stats.items(), key=lambda item: -item[1]['wall_time']))
+
+    def toJson(self):
+        return json.dumps(self.report(), indent=1)
+
+
+RECORDER = Recorder()
+_CURRENT = contextvars.ContextVar('recorder', default=None) # Recorder of the current run, when one was set
+
+
+def setRecorder(recorder):
+    """Record the measures of the current context (e.g. the thread of one app run) into recorder instead of RECORDER,
+    so that concurrent runs neither mix nor reset their measures. The workers of a thread Pool still record into RECORDER"""
+    _CURRENT.set(recorder)
+
+
+def currentRecorder():
+    current = _CURRENT.get()
+    return RECORDER if current is None else current
+
+
+def _optimizerCounts(result):
+    """Total nit and nfev of the OptimizeResults in a result (alone, or in a tuple/list)"""
+    results = result if isinstance(result, (tuple, list)) else (result,)
+    nit = nfev = 0
+    for item in results:
+        if isinstance(item, dict) and 'nfev' in item:
+            nit += item.get('nit', 0)
+            nfev += item['nfev']
+    return nit, nfev
+
+
+def instrumented(function):
+    """Record the wall time, optimizer counts and argument array shapes of every call of a function.
+
+    Meant for the solver entry points and the stages, not for the functions called inside the optimizer loops
+    (their evaluations are the nfev of the solver)"""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not ENABLED:
+            return function(*args, **kwargs)
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        wall_time = time.perf_counter() - start
+        shapes = [tuple(arg.shape) for arg in args if hasattr(arg, 'shape')]
+        currentRecorder().record(function.__name__, wall_time, *_optimizerCounts(result), shapes)
+        return result
+    return wrapper
+
+
+@contextmanager
+def stage(name):
+    """Record the wall time of a block of code (data download, rendering...) as name"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if ENABLED:
+            currentRecorder().record(name, time.perf_counter() - start)
+
+
+##############################
+#          Profiling         #
+##############################
+
+class Profile:
+    """Opt-in profiler of a whole run : cProfile (default) or pyinstrument if it is installed"""
+
+    def __init__(self, tool='cprofile'):
+        self.tool = tool
+        if tool == 'pyinstrument':
+            from pyinstrument import Profiler
+            self.profiler = Profiler()
+        elif tool == 'cprofile':
+            import cProfile
+            self.profiler = cProfile.Profile()
+        else:
+            raise ValueError("tool must be 'cprofile' or 'pyinstrument'")
+
+    def start(self):
+        if self.tool == 'pyinstrument':
+            self.profiler.start()
+        else:
+            self.profiler.enable()
+
+    def stop(self):
+        if self.tool == 'pyinstrument':
+            self.profiler.stop()
+        else:
+            self.profiler.disable()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def dump(self, path):
+        """Write the profile : .prof file (for pstats, snakeviz...) or pyinstrument HTML page"""
+        if self.tool == 'pyinstrument':
+            with open(path, 'w') as file:
+                file.write(self.profiler.output_html())
+        else:
+            self.profiler.dump_stats(path)
+
+    def summary(self, limit=25):
+        """Text summary of the most expensive functions"""
+        if self.tool == 'pyinstrument':
+            return self.profiler.output_text()
+        import pstats
+        stream = io.StringIO()
+        pstats.Stats(self.profiler, stream=stream).sort_stats('cumulative').print_stats(limit)
+        return stream.getvalue()
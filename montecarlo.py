@@ -0,0 +1,249 @@
+##############################
+#          Libraries         #
+##############################
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import covariance as cv
+
+
+##############################
+#         Parameters         #
+##############################
+
+CHUNK_ELEMENTS = 2**20 # random draws generated at once (paths per chunk x days)
+EXACT_LIMIT = 2**17 # up to this number of simulations, the quantiles are exact
+SKETCH_BINS = 2**14
+SKETCH_WIDTH = 12 # the histogram covers center +/- SKETCH_WIDTH * scale, the rest goes to 2 overflow bins
+
+
+##############################
+#       Quantile sketch      #
+##############################
+
+class QuantileSketch:
+    """Memory-bounded set of simulated values which can be merged and queried for quantiles.
+
+    The values are kept as they are up to exact_limit values (quantiles are then the same as
+    np.percentile), and are then replaced by a fixed histogram of n_bins bins around center."""
+
+    def __init__(self, center, scale, exact_limit=EXACT_LIMIT, n_bins=SKETCH_BINS, width=SKETCH_WIDTH):
+        scale = max(scale, 1e-12)
+        self.lower = center - width*scale
+        self.upper = center + width*scale
+        self.n_bins = n_bins
+        self.exact_limit = exact_limit
+        self.values = [] # exact values, None once the histogram is used
+        self.size = 0
+        self.counts = None # underflow bin, n_bins bins, overflow bin
+        self.minimum = np.inf
+        self.maximum = -np.inf
+
+    def _toHistogram(self):
+        values = np.concatenate(self.values) if self.values else np.empty(0)
+        self.values = None
+        self.counts = np.zeros(self.n_bins + 2, dtype=np.int64)
+        self._count(values)
+
+    def _count(self, values):
+        bins = np.floor((values - self.lower)*(self.n_bins/(self.upper - self.lower))).astype(np.int64) + 1
+        self.counts += np.bincount(np.clip(bins, 0, self.n_bins + 1), minlength=self.n_bins + 2)
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) == 0:
+            return
+        self.size += len(values)
+        self.minimum = min(self.minimum, values.min())
+        self.maximum = max(self.maximum, values.max())
+        if self.values is not None and self.size > self.exact_limit:
+            self._toHistogram()
+        if self.values is not None:
+            self.values.append(values)
+        else:
+            self._count(values)
+
+    def merge(self, other):
+        """Add the values of another sketch built with the same center, scale and bins"""
+        if other.values is not None:
+            for values in other.values:
+                self.add(values)
+            return
+        if self.values is not None:
+            self._toHistogram()
+        self.counts += other.counts
+        self.size += other.size
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+
+    def quantile(self, q):
+        """Quantile(s) of the values, with the same (linear) interpolation as np.percentile"""
+        if self.values is not None:
+            return np.percentile(np.concatenate(self.values), np.asarray(q)*100)
+        ranks = np.asarray(q, dtype=float)*(self.size - 1)
+        cumulative = np.cumsum(self.counts)
+        bins = np.searchsorted(cumulative, ranks, side='right')
+        inside = (ranks - (cumulative[bins] - self.counts[bins]) + 0.5)/self.counts[bins] # position in the bin
+        width = (self.upper - self.lower)/self.n_bins
+        left = np.where(bins == 0, self.minimum, self.lower + (bins - 1)*width)
+        right = np.where(bins == self.n_bins + 1, self.maximum, self.lower + bins*width)
+        return np.clip(left + inside*(right - left), self.minimum, self.maximum)
+
+
+##############################
+#         Simulation         #
+##############################
+
+def logReturnSketches(means, stds, time_horizons, num_simulations, rng=None, dtype=np.float64, chunk_elements=CHUNK_ELEMENTS,
+                      exact_limit=EXACT_LIMIT):
+    """Simulate normal daily returns for several portfolios and stream the log of the compounded returns into sketches.
+
+    The paths are generated by chunks of about chunk_elements draws, and every portfolio uses the
+    same draws. The daily log-returns are summed, so no path of portfolio values is stored.
+    Returns sketches[p][h] : the sketch of portfolio p over time_horizons[h] (exact up to exact_limit values)."""
+    rng = np.random.default_rng() if rng is None else rng
+    dtype = np.dtype(dtype).type
+    means, stds = np.atleast_1d(means), np.atleast_1d(stds)
+    time_horizons = np.atleast_1d(np.asarray(time_horizons, dtype=int))
+    horizon = time_horizons.max()
+    sketches = [[QuantileSketch(h*(mean - std**2/2), std*np.sqrt(h), exact_limit) for h in time_horizons]
+                for mean, std in zip(means, stds)]
+    chunk = max(1, chunk_elements//horizon)
+    floor = dtype(-1 + np.finfo(dtype).eps) # a day cannot lose more than the whole value
+    for first in range(0, num_simulations, chunk):
+        draws = rng.standard_normal(size=(min(chunk, num_simulations - first), horizon), dtype=dtype)
+        for p in range(len(means)):
+            daily = np.maximum(dtype(means[p]) + dtype(stds[p])*draws, floor)
+            log_returns = np.cumsum(np.log1p(daily), axis=1)
+            for h, time_horizon in enumerate(time_horizons):
+                sketches[p][h].add(log_returns[:, time_horizon - 1])
+    return sketches
+
+
+def quantileReturn(sketch, q):
+    """Quantile of the compounded return from a sketch of log-returns"""
+    return np.expm1(sketch.quantile(q))
+
+
+def quantileStandardError(sketch, q):
+    """Asymptotic standard error of quantileReturn : sqrt(q(1 - q)/n)/density at the quantile.
+
+    The density is estimated from the sketch itself as 2h/(quantile(q + h) - quantile(q - h)) (Siddiqui), with the
+    Hall-Sheather bandwidth h, and the error of the log-return is carried to the compounded return by the delta method."""
+    from statistics import NormalDist
+    q = np.asarray(q, dtype=float)
+    normal = NormalDist()
+    x = np.vectorize(normal.inv_cdf)(q)
+    density = np.vectorize(normal.pdf)(x)
+    h = sketch.size**(-1/3)*normal.inv_cdf(0.975)**(2/3)*(1.5*density**2/(2*x**2 + 1))**(1/3)
+    h = np.minimum(h, np.minimum(q, 1 - q)/2)
+    spread = (sketch.quantile(q + h) - sketch.quantile(q - h))/(2*h) # 1/density
+    return np.sqrt(q*(1 - q)/sketch.size)*spread*np.exp(sketch.quantile(q))
+
+
+##############################
+#     Parallel simulation    #
+##############################
+
+def _logReturnTask(means, stds, time_horizons, num_simulations, seed_sequence, dtype, chunk_elements, exact_limit):
+    """Simulation of one worker, from its own seed stream : only the sketches go back to the parent, not the paths"""
+    return logReturnSketches(means, stds, time_horizons, num_simulations, np.random.default_rng(seed_sequence), dtype, chunk_elements,
+                             exact_limit)
+
+
+def parallelLogReturnSketches(means, stds, time_horizons, num_simulations, seed=None, max_workers=2, executor='process',
+                              dtype=np.float64, chunk_elements=CHUNK_ELEMENTS):
+    """logReturnSketches split over max_workers workers, each one with a stream of SeedSequence(seed).spawn(max_workers).
+
+    Every worker simulates num_simulations/max_workers paths and returns its sketches, which are merged in
+    the order of the workers : the result only depends on seed and max_workers (not on the scheduling).
+    The workers keep their values exact only if all of them together fit in EXACT_LIMIT (as a serial run),
+    else they send fixed-size histograms, so that the memory does not grow with max_workers."""
+    children = np.random.SeedSequence(seed).spawn(max_workers)
+    counts = [num_simulations//max_workers + (i < num_simulations % max_workers) for i in range(max_workers)]
+    exact_limit = EXACT_LIMIT if num_simulations <= EXACT_LIMIT else 0
+    tasks = [(means, stds, time_horizons, count, child, dtype, chunk_elements, exact_limit)
+             for count, child in zip(counts, children) if count > 0]
+    if len(tasks) == 1:
+        parts = [_logReturnTask(*tasks[0])]
+    else:
+        Executor = ProcessPoolExecutor if executor == 'process' else ThreadPoolExecutor
+        with Executor(len(tasks)) as pool:
+            parts = list(pool.map(_logReturnTask, *zip(*tasks)))
+    sketches = parts[0]
+    for part in parts[1:]:
+        for portfolio, other_portfolio in zip(sketches, part):
+            for sketch, other in zip(portfolio, other_portfolio):
+                sketch.merge(other)
+    return sketches
+
+
+##############################
+#    Multi-asset simulation  #
+##############################
+
+def covarianceFactor(cov_matrix):
+    """Matrix L such that L.L^T = cov_matrix : Cholesky factor, or eigen factor (negative eigenvalues set to 0) if cov_matrix is not positive definite.
+    A FactorCovariance is kept as it is (it computes L^T.w itself, with k + N random sources)."""
+    if isinstance(cov_matrix, cv.FactorCovariance):
+        return cov_matrix
+    cov_matrix = np.asarray(cov_matrix, dtype=float)
+    try:
+        return np.linalg.cholesky(cov_matrix)
+    except np.linalg.LinAlgError:
+        values, vectors = np.linalg.eigh(cov_matrix)
+        return vectors*np.sqrt(np.clip(values, 0, None))
+
+
+class MultiAssetSimulator:
+    """Correlated asset-level Monte Carlo simulation, whose paths score any number of portfolios.
+
+    The covariance is factored once. Every call replays the same random stream (from a
+    numpy SeedSequence), so all the portfolios and all the calls share common random numbers."""
+
+    def __init__(self, mean_returns, cov_matrix, seed=None, dtype=np.float64, chunk_elements=CHUNK_ELEMENTS):
+        self.mean_returns = np.asarray(mean_returns, dtype=float)
+        self.factor = covarianceFactor(cov_matrix)
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.dtype = np.dtype(dtype).type
+        self.chunk_elements = chunk_elements
+
+    @classmethod
+    def fromReturns(cls, returns, seed=None, dtype=np.float64):
+        """Simulator with the mean and covariance of daily returns (the 1st line, NaN, is dropped)"""
+        returns = np.asarray(returns, dtype=float)[1:]
+        return cls(returns.mean(axis=0), np.cov(returns, rowvar=False, bias=True), seed, dtype)
+
+    def sketches(self, weights, time_horizons, num_simulations):
+        """Sketches of the log compounded returns, sketches[p][h] for the portfolio weights[p] over time_horizons[h]"""
+        weights = np.atleast_2d(np.asarray(weights, dtype=float))
+        time_horizons = np.atleast_1d(np.asarray(time_horizons, dtype=int))
+        horizon = time_horizons.max()
+        # asset returns = mean + L.z, so portfolio returns = w.mean + (L^T w).z : one product scores every portfolio
+        drifts = np.dot(weights, self.mean_returns)
+        if isinstance(self.factor, cv.FactorCovariance):
+            loadings = self.factor.sqrtTransposeDot(weights.T)
+        else:
+            loadings = np.dot(self.factor.T, weights.T)
+        loadings = loadings.astype(self.dtype) # random sources x portfolios
+        stds = np.sqrt(np.sum(loadings.astype(float)**2, axis=0))
+        sketches = [[QuantileSketch(h*(drift - std**2/2), std*np.sqrt(h)) for h in time_horizons]
+                    for drift, std in zip(drifts, stds)]
+
+        rng = np.random.Generator(np.random.PCG64(self.seed_sequence))
+        n_sources = len(loadings)
+        chunk = max(1, self.chunk_elements//(horizon*max(n_sources, len(weights))))
+        floor = self.dtype(-1 + np.finfo(self.dtype).eps) # a day cannot lose more than the whole value
+        for first in range(0, num_simulations, chunk):
+            draws = rng.standard_normal(size=(min(chunk, num_simulations - first), horizon, n_sources), dtype=self.dtype)
+            daily = np.maximum(np.dot(draws, loadings) + drifts.astype(self.dtype), floor) # paths x days x portfolios
+            log_returns = np.cumsum(np.log1p(daily), axis=1)
+            for p in range(len(weights)):
+                for h, time_horizon in enumerate(time_horizons):
+                    sketches[p][h].add(log_returns[:, time_horizon - 1, p])
+        return sketches
+
+    def var(self, weights, confidence_levels, time_horizon, num_simulations):
+        """Monte Carlo VaR of every portfolio (rows) for every confidence level (columns)"""
+        quantiles = 1 - np.atleast_1d(np.asarray(confidence_levels, dtype=float))
+        return np.array([quantileReturn(sketch, quantiles) for (sketch,) in self.sketches(weights, time_horizon, num_simulations)])
@@ -0,0 +1,66 @@
+##############################
+#          Libraries         #
+##############################
+
+import numpy as np
+import returns_matrix as rm
+
+
+##############################
+#       Optimizer state      #
+##############################
+
+class OptimizerState:
+    """Moments and optimal weights of the last basket, kept between two runs of a session (e.g. in st.session_state).
+
+    When the basket changes by a few tickers over the same dates, the mean and covariance entries of the
+    tickers already known are reused and only the rows and columns of the new tickers are computed
+    (pairwise complete days, as DataFrame.cov). The optimizers then start from the previous weights
+    of the tickers that remain, renormalized, instead of the equal weights."""
+
+    def __init__(self):
+        self.key = None # dates of the returns : the moments are only reused over the same dates
+        self.tickers = []
+        self.mean = np.empty(0)
+        self.cov = np.empty((0, 0))
+        self.weights = {} # portfolio name -> {ticker: weight}
+        self.computed = 0 # tickers whose moments were computed by the last call of moments
+
+    def moments(self, returns, key=None):
+        """Mean and covariance (labelled, as DataFrame.mean and DataFrame.cov) of the returns (ReturnsMatrix or DataFrame)"""
+        import pandas as pd
+        if not isinstance(returns, rm.ReturnsMatrix):
+            returns = rm.ReturnsMatrix.fromFrame(returns)
+        if key != self.key:
+            self.__init__()
+            self.key = key
+        tickers = list(returns.columns)
+        positions = {ticker: i for i, ticker in enumerate(self.tickers)}
+        known = [i for i, ticker in enumerate(tickers) if ticker in positions]
+        new = [i for i, ticker in enumerate(tickers) if ticker not in positions]
+        previous = [positions[tickers[i]] for i in known]
+
+        mean = np.empty(len(tickers))
+        cov = np.empty((len(tickers), len(tickers)))
+        mean[known] = self.mean[previous]
+        cov[np.ix_(known, known)] = self.cov[np.ix_(previous, previous)]
+        if new:
+            mean[new] = returns.meanArray(new)
+            block = returns.covArray(new) # every ticker x new tickers
+            cov[:, new] = block
+            cov[new, :] = block.T
+
+        self.tickers, self.mean, self.cov, self.computed = tickers, mean, cov, len(new)
+        return pd.Series(mean, index=tickers), pd.DataFrame(cov, index=tickers, columns=tickers)
+
+    def initialGuess(self, name, tickers):
+        """Previous weights of the portfolio for the tickers (the new ones at 0), renormalized, or None"""
+        if name not in self.weights:
+            return None
+        guess = np.array([self.weights[name].get(ticker, 0.) for ticker in tickers])
+        if guess.sum() <= 0:
+            return None
+        return guess/guess.sum()
+
+    def remember(self, name, tickers, weights):
+        self.weights[name] = dict(zip(tickers, np.asarray(weights, dtype=float)))
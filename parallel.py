@@ -0,0 +1,148 @@
+##############################
+#          Libraries         #
+##############################
+
+import numpy as np
+import covariance as cv
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+
+##############################
+#        Shared arrays       #
+##############################
+
+_WORKER_ARRAYS = {} # name -> ndarray, set in every worker by _initWorker
+_WORKER_MEMORY = [] # keeps the shared memory blocks of the worker open
+
+
+def _attach(name):
+    """Open an existing shared memory block, which stays owned (and unlinked) by the parent process"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError: # Python < 3.13 : the workers share the resource tracker of the parent, so registering again is harmless
+        return shared_memory.SharedMemory(name=name)
+
+
+def _initWorker(descriptors):
+    """Map the shared arrays in a process worker"""
+    for name, (memory_name, shape, dtype) in descriptors.items():
+        memory = _attach(memory_name)
+        _WORKER_MEMORY.append(memory)
+        _WORKER_ARRAYS[name] = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+
+
+class SharedArrays:
+    """Copy arrays once to shared memory, so that process workers read them without pickling them per task"""
+
+    def __init__(self, **arrays):
+        self.memory = []
+        self.descriptors = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)[...] = array
+            self.memory.append(memory)
+            self.descriptors[name] = (memory.name, array.shape, array.dtype.str)
+
+    def close(self):
+        for memory in self.memory:
+            memory.close()
+            memory.unlink()
+        self.memory = []
+
+
+##############################
+#        Worker tasks        #
+##############################
+
+def _problemArrays(mean_returns, cov_matrix):
+    """Arrays describing a problem : the mean returns and the dense covariance or the factor model components"""
+    arrays = {'mean_returns': np.asarray(mean_returns, dtype=float)}
+    if isinstance(cov_matrix, cv.FactorCovariance):
+        arrays.update(cov_matrix.components())
+    else:
+        arrays['cov_matrix'] = np.asarray(cov_matrix, dtype=float)
+    return arrays
+
+
+def _problem(arrays):
+    """(mean returns, covariance) of the arrays of a task : None in a process worker (the shared arrays are used),
+    and the arrays themselves in a thread"""
+    arrays = _WORKER_ARRAYS if arrays is None else arrays
+    if 'cov_matrix' in arrays:
+        return arrays['mean_returns'], arrays['cov_matrix']
+    return arrays['mean_returns'], cv.FactorCovariance(arrays['loadings'], arrays['factor_cov'], arrays['specific'])
+
+
+def _maximumSharpeRatio(arrays, risk_free_rate, constraint_set):
+    import portfolio_optimization as po
+    return po.maximumSharpeRatio(*_problem(arrays), risk_free_rate, constraint_set)
+
+
+def _minimumVariance(arrays, constraint_set):
+    import portfolio_optimization as po
+    return po.minimumVariance(*_problem(arrays), constraint_set)
+
+
+def _efficientFrontier(arrays, target_returns, constraint_set, initial_guess):
+    import portfolio_optimization as po
+    return po.efficientFrontier(*_problem(arrays), target_returns, constraint_set, initial_guess)
+
+
+##############################
+#            Pool            #
+##############################
+
+class Pool:
+    """Executor solving the optimizations of one (mean returns, covariance) problem on several cores.
+
+    kind = 'process' shares the arrays with the workers through shared memory,
+    kind = 'thread' shares them directly. Results are returned in the same order as
+    the serial functions, and do not depend on the scheduling of the workers."""
+
+    def __init__(self, mean_returns, cov_matrix, max_workers, kind='process'):
+        self.max_workers = max_workers
+        self.shared = None
+        self.arrays = None
+        arrays = _problemArrays(mean_returns, cov_matrix)
+        if kind == 'process':
+            self.shared = SharedArrays(**arrays)
+            self.executor = ProcessPoolExecutor(max_workers, initializer=_initWorker, initargs=(self.shared.descriptors,))
+        elif kind == 'thread':
+            self.arrays = arrays
+            self.executor = ThreadPoolExecutor(max_workers)
+        else:
+            raise ValueError("kind must be 'process' or 'thread'")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown()
+        if self.shared is not None:
+            self.shared.close()
+
+    def extremePortfolios(self, risk_free_rate, constraint_set):
+        """Solve the max Sharpe ratio and the min volatility portfolios at the same time"""
+        max_SR = self.executor.submit(_maximumSharpeRatio, self.arrays, risk_free_rate, constraint_set)
+        min_volatility = self.executor.submit(_minimumVariance, self.arrays, constraint_set)
+        return max_SR.result(), min_volatility.result()
+
+    def efficientFrontier(self, target_returns, constraint_set, start_weights, end_weights):
+        """Trace the efficient frontier between two portfolios, one block of consecutive targets per worker.
+
+        Each block is warm-started from the mix of start_weights and end_weights whose return
+        is the first target of the block (the return is linear in the weights, so this mix is
+        feasible when the targets are spread between the returns of the two portfolios)."""
+        target_returns = np.asarray(target_returns, dtype=float)
+        blocks = [block for block in np.array_split(np.arange(len(target_returns)), self.max_workers) if len(block)]
+        futures = []
+        for block in blocks:
+            t = block[0]/max(len(target_returns) - 1, 1)
+            initial_guess = (1 - t)*np.asarray(start_weights) + t*np.asarray(end_weights)
+            futures.append(self.executor.submit(_efficientFrontier, self.arrays, target_returns[block], constraint_set, initial_guess))
+        return [result for future in futures for result in future.result()]
@@ -2,24 +2,27 @@
 #          Libraries         #
 ##############################
 
+# Only NumPy is imported with the module : SciPy, pandas, plotly, matplotlib and the price store
+# (yfinance) are imported by the functions which need them, so that the numeric core loads fast
 import numpy as np
 import datetime as dt
-import yfinance as yf
-from scipy.optimize import minimize
-from scipy.stats import norm
-import pandas as pd
-import plotly.graph_objects as go
-import matplotlib.pyplot as plt
-import companies as co
+import hashlib
+import functools
+import inspect
+import copy
+import threading
+from collections import OrderedDict
+import montecarlo as mc
+import covariance as cv
+import returns_matrix as rm
+import instrumentation as ins
 
 
 ##############################
 #         Parameters         #
 ##############################
 
-TICKERS = [ticker for sector in co.companies.values() for ticker in sector.values()]
 START_DATE = '2020-01-01'
-END_DATE = dt.datetime.now()
 N_TRADING_DAYS = 252
 RISK_FREE_RATE = 0.015
 CONSTRAINT_SET = (0,0.5) # no short, we can have 50% of the same asset
@@ -27,32 +30,212 @@ TARGET = 0.06
 CONFIDENCE_LEVEL = ["90 %", "95 %", "99 %"]
 TIME_HORIZONS = ["10 jours", "176 jours ", "252 jours"]
 N_SIMULATIONS = 10000
+PRICE_STORE_DIR = '.price_store'
+COV_ESTIMATOR = 'sample' # 'sample', 'ledoitWolf', 'sector' or 'pca' (see covariance.ESTIMATORS)
+PRICE_STORE = None # created at the first use by priceStore(), or set a PriceStore with another source (e.g. ps.CsvSource) to work without yfinance
+RESULT_CACHE_SIZE = 64
+FRONTIER_POINTS = 20
+MAX_WORKERS = None # None : every optimization runs serially, else number of parallel workers
+EXECUTOR = 'process' # 'process' or 'thread'
+RANDOM_PORTFOLIOS = 10**6 # random portfolios drawn for the cloud of efficientFrontierGraph (0 : no cloud)
+CLOUD_POINTS = 4096 # at most this many of them are plotted (the best Sharpe ratio of each cell of a 64 x 64 grid)
+CLOUD_MARGIN = 0.1 # the grid spans the range of the first random portfolios, widened by this fraction on each side
+
+
+def __getattr__(name):
+    """Parameters computed at their first use : TICKERS (all the tickers of companies.py) and END_DATE (now)"""
+    if name == 'TICKERS':
+        import companies as co
+        value = [ticker for sector in co.companies.values() for ticker in sector.values()]
+    elif name == 'END_DATE':
+        value = dt.datetime.now()
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value # computed once, as a normal parameter
+    return value
+
+
+# arguments whose None default stands for a parameter, read at each call (so that changing the parameter after
+# the import is taken into account)
+_SETTINGS = {'n_points': 'FRONTIER_POINTS', 'max_workers': 'MAX_WORKERS', 'executor': 'EXECUTOR',
+             'cov_estimator': 'COV_ESTIMATOR', 'n_portfolios': 'RANDOM_PORTFOLIOS', 'max_points': 'CLOUD_POINTS'}
+
+
+def _setting(value, argument):
+    """Value of an argument, or the current value of its parameter (see _SETTINGS) when it is None"""
+    return globals()[_SETTINGS[argument]] if value is None else value
+
+
+##############################
+#        Result cache        #
+##############################
+
+class ResultCache:
+    """Bounded LRU cache of the optimization results, with hit/miss counters.
+
+    It is shared by the threads of a thread Pool : the lock guards the dictionary, not the computations"""
+
+    def __init__(self, maxsize=RESULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, compute):
+        """Return the cached result of the key, or compute and store it"""
+        with self.lock:
+            if key in self.results:
+                self.hits += 1
+                self.results.move_to_end(key)
+                return self.results[key]
+            self.misses += 1
+        result = compute() # two threads missing the same key both compute it, the results are the same
+        with self.lock:
+            self.results[key] = result
+            if len(self.results) > self.maxsize:
+                self.results.popitem(last=False) # least recently used
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.results), 'maxsize': self.maxsize}
+
+
+RESULT_CACHE = ResultCache()
+
+
+def _hashValue(hash, value):
+    """Feed a value (array, pandas object, number, sequence...) to a hash.
+
+    Sequences of numbers are hashed as float arrays, so (0, 0.5), [0, 0.5] and np.array([0., .5]) give the same key"""
+    index = getattr(value, 'index', None)
+    if index is not None and not callable(index): # pandas object (str, list... have an index method)
+        hash.update(repr(list(index)).encode())
+    if isinstance(value, cv.FactorCovariance):
+        value = np.concatenate([array.ravel() for array in value.components().values()])
+    if isinstance(value, (tuple, list)):
+        try:
+            value = np.asarray(value, dtype=float) # numbers, (N, 2) bounds, initial guesses of the same length...
+        except (TypeError, ValueError):
+            hash.update(f'({len(value)}'.encode()) # e.g. an inequality (matrix, vector), or a None inside
+            for item in value:
+                _hashValue(hash, item)
+            hash.update(b')')
+            return
+    if hasattr(value, 'shape'):
+        array = np.ascontiguousarray(value, dtype=float)
+        hash.update(repr(array.shape).encode())
+        hash.update(array.tobytes())
+    elif isinstance(value, (int, float, np.number)) and not isinstance(value, bool):
+        hash.update(repr(float(value)).encode()) # 0 and 0.0 are the same input
+    else:
+        hash.update(repr(value).encode())
+
+
+def resultKey(name, arguments):
+    """Key of a result : hash of the function name and of all its (name, value) arguments"""
+    hash = hashlib.sha1(name.encode())
+    for argument, value in arguments.items():
+        hash.update(argument.encode())
+        _hashValue(hash, value)
+    return hash.hexdigest()
+
+
+def cachedResult(function):
+    """Share the result of an optimization between every caller with the same inputs.
+
+    The key is built from the arguments bound to the signature with their defaults, so positional, keyword
+    and omitted arguments of the same value share it (None settings count as their current parameter).
+    Every caller gets its own copy of the result."""
+    signature = inspect.signature(function)
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        arguments = {argument: _setting(value, argument) if argument in _SETTINGS else value for argument, value in bound.arguments.items()}
+        key = resultKey(function.__name__, arguments)
+        return copy.deepcopy(RESULT_CACHE.get(key, lambda: function(*args, **kwargs)))
+    return wrapper
 
 
 ##############################
 #            Code            #
 ##############################
 
-def getData(stocks, start, end):
-    """Import the data"""
-    data = yf.download(stocks, start, end)['Adj Close']
-    returns = data.pct_change()
+def priceStore():
+    """Price store used by getData and getAllReturns (PRICE_STORE, created in PRICE_STORE_DIR if it was not set)"""
+    global PRICE_STORE
+    if PRICE_STORE is None:
+        import price_store as ps
+        PRICE_STORE = ps.PriceStore(PRICE_STORE_DIR, ps.ChunkedSource(ps.YahooSource())) # chunked requests, retried on failure
+    return PRICE_STORE
+
+@ins.instrumented
+def getData(stocks, start, end, cov_estimator=None):
+    """Import the data (cov_estimator : COV_ESTIMATOR by default)"""
+    returns = getAllReturns(stocks, start, end)
     mean_returns = returns.mean()
-    cov_matrix = returns.cov()
+    cov_matrix = cv.estimateCovariance(returns, _setting(cov_estimator, 'cov_estimator'))
     return mean_returns, cov_matrix
 
+@ins.instrumented
 def getAllReturns(stocks, start, end):
-    data = yf.download(stocks, start, end)['Adj Close']
+    """Get the daily returns of the stocks, from the local price store"""
+    data = priceStore().getPrices(stocks, start, end)
     returns = data.pct_change()
     return returns
 
+@ins.instrumented
+def getReturnsMatrix(stocks, start, end, dtype=np.float64):
+    """Get the daily returns of the stocks as a ReturnsMatrix (float64 or float32), which the optimizers and VaR functions use without pandas"""
+    return rm.ReturnsMatrix.fromFrame(getAllReturns(stocks, start, end), dtype)
+
 def portfolioPerformance(weights, mean_returns, cov_matrix):
     """Get the returns and standard deviation of the portfolio"""
-    returns = np.sum(mean_returns*weights)*N_TRADING_DAYS
-    std = np.sqrt(np.dot(weights.T, np.dot(cov_matrix, weights)))*np.sqrt(N_TRADING_DAYS) # variance = w^T * sum(w)
+    returns = np.dot(mean_returns, weights)*N_TRADING_DAYS
+    std = np.sqrt(np.dot(weights.T, cv.covDot(cov_matrix, weights)))*np.sqrt(N_TRADING_DAYS) # variance = w^T * sum(w)
     return returns, std
 
 
+def _asArrays(mean_returns, cov_matrix):
+    """Raw ndarrays of the mean returns and covariance (or the factor covariance), used inside the optimizer loops"""
+    return np.asarray(mean_returns, dtype=float), cv.asCovariance(cov_matrix)
+
+
+def _initialGuess(initial_guess, num_assets):
+    """Starting point of a solve : the given weights (warm start) or every weight = 1/num_assets"""
+    if initial_guess is None:
+        return np.full(num_assets, 1./num_assets)
+    return np.asarray(initial_guess, dtype=float)
+
+
+def _linearConstraint(matrix, vector):
+    """Equality constraint matrix * x = vector, with its (constant) jacobian"""
+    return {'type': 'eq',
+            'fun': lambda x: np.dot(matrix, x) - vector,
+            'jac': lambda x: matrix}
+
+
+def _linearInequality(matrix, vector):
+    """Inequality constraint matrix * x <= vector (e.g. sector weight caps), with its (constant) jacobian"""
+    return {'type': 'ineq',
+            'fun': lambda x: vector - np.dot(matrix, x),
+            'jac': lambda x: -matrix}
+
+
+def _bounds(constraint_set, num_assets):
+    """Bounds of the weights : the same (min, max) for every asset, or one (min, max) per asset"""
+    if np.ndim(constraint_set) == 2:
+        return tuple(tuple(bound) for bound in constraint_set)
+    return tuple(constraint_set for asset in range(num_assets))
+
+
 def negSharpeRatio(weights, mean_returns, cov_matrix, risk_free_rate): # and then take the min of the negative to get the max SR
     """Compute the negative Sharpe ratio"""
     returns, std = portfolioPerformance(weights, mean_returns, cov_matrix)
@@ -60,20 +243,31 @@ def negSharpeRatio(weights, mean_returns, cov_matrix, risk_free_rate): # and the
     return -sharpe_ratio
 
 
-def maximumSharpeRatio(mean_returns, cov_matrix, risk_free_rate, constraint_set):
-    """Compute the results with the highest Sharpe Ratio"""
+def negSharpeRatioGradient(weights, mean_returns, cov_matrix, risk_free_rate):
+    """Gradient of the negative Sharpe ratio with respect to the weights"""
+    cov_weights = cv.covDot(cov_matrix, weights)*N_TRADING_DAYS
+    returns = np.dot(mean_returns, weights)*N_TRADING_DAYS
+    std = np.sqrt(np.dot(weights, cov_weights))
+    # d(returns)/dw = mean*N and d(std)/dw = cov.w*N/std
+    return -(mean_returns*N_TRADING_DAYS*std - (returns - risk_free_rate)*cov_weights/std)/std**2
+
+
+@cachedResult
+@ins.instrumented
+def maximumSharpeRatio(mean_returns, cov_matrix, risk_free_rate, constraint_set, initial_guess=None, inequality=None):
+    """Compute the results with the highest Sharpe Ratio (inequality : optional (matrix, vector) with matrix * weights <= vector)"""
+    from scipy.optimize import minimize
     num_assets = len(mean_returns)
-    args = (mean_returns, cov_matrix, risk_free_rate)
-    constraints = (
-        {'type': 'eq',
-         'fun': lambda x: np.sum(x)-1
-         })
-    bound = constraint_set
-    bounds = tuple(bound for asset in range(num_assets))
+    args = _asArrays(mean_returns, cov_matrix) + (risk_free_rate,)
+    constraints = [_linearConstraint(np.ones((1, num_assets)), np.ones(1))] # sum of the weights = 1
+    if inequality is not None:
+        constraints.append(_linearInequality(*inequality))
+    bounds = _bounds(constraint_set, num_assets)
     result = minimize(negSharpeRatio,
-                         num_assets*[1./num_assets], # initial guess : let's assume that every weight = 1/num_assets
+                         _initialGuess(initial_guess, num_assets),
                          args=args,
                          method='SLSQP',
+                         jac=negSharpeRatioGradient,
                          bounds=bounds,
                          constraints=constraints) 
     return result
@@ -84,20 +278,28 @@ def portfolioVariance(weights, mean_returns, cov_matrix):
     return portfolioPerformance(weights, mean_returns, cov_matrix)[1]
 
 
-def minimumVariance(mean_returns, cov_matrix, constraint_set):
-    """Compute the portfolio with minimum variance"""
+def portfolioVarianceGradient(weights, mean_returns, cov_matrix):
+    """Gradient of portfolioVariance (the annualised standard deviation) with respect to the weights"""
+    cov_weights = cv.covDot(cov_matrix, weights)*N_TRADING_DAYS
+    return cov_weights/np.sqrt(np.dot(weights, cov_weights))
+
+
+@cachedResult
+@ins.instrumented
+def minimumVariance(mean_returns, cov_matrix, constraint_set, initial_guess=None, inequality=None):
+    """Compute the portfolio with minimum variance (inequality : optional (matrix, vector) with matrix * weights <= vector)"""
+    from scipy.optimize import minimize
     num_assets = len(mean_returns)
-    args = (mean_returns, cov_matrix)
-    constraints = (
-        {'type': 'eq',
-         'fun': lambda x: np.sum(x)-1
-         })
-    bound = constraint_set
-    bounds = tuple(bound for asset in range(num_assets))
+    args = _asArrays(mean_returns, cov_matrix)
+    constraints = [_linearConstraint(np.ones((1, num_assets)), np.ones(1))] # sum of the weights = 1
+    if inequality is not None:
+        constraints.append(_linearInequality(*inequality))
+    bounds = _bounds(constraint_set, num_assets)
     result = minimize(portfolioVariance,
-                         num_assets*[1./num_assets], # initial guess : let's assume that every weight = 1/num_assets
+                         _initialGuess(initial_guess, num_assets),
                          args=args,
                          method='SLSQP',
+                         jac=portfolioVarianceGradient,
                          bounds=bounds,
                          constraints=constraints) 
     return result
@@ -107,53 +309,177 @@ def portfolioReturn(weights, mean_returns, cov_matrix):
     return portfolioPerformance(weights, mean_returns, cov_matrix)[0]
 
 
-def efficientOptimization(mean_returns, cov_matrix, return_target, constraint_set):
+@ins.instrumented
+def efficientOptimization(mean_returns, cov_matrix, return_target, constraint_set, initial_guess=None):
     """Optimize the portfolio for a target"""
+    from scipy.optimize import minimize
     num_assets = len(mean_returns)
-    args = (mean_returns, cov_matrix)
-    constraints = (
-        {'type': 'eq', 'fun': lambda x: portfolioReturn(x, mean_returns, cov_matrix) - return_target},
-        {'type': 'eq', 'fun': lambda x: np.sum(x)-1})
-    bound = constraint_set
-    bounds = tuple(bound for asset in range(num_assets))
+    args = _asArrays(mean_returns, cov_matrix)
+    # sum of the weights = 1 and portfolio return = target, as one linear constraint
+    constraints = _linearConstraint(np.vstack([np.ones(num_assets), args[0]*N_TRADING_DAYS]),
+                                    np.array([1., return_target]))
+    bounds = _bounds(constraint_set, num_assets)
     eff_opt = minimize(portfolioVariance,
-                         num_assets*[1./num_assets], # initial guess : let's assume that every weight = 1/num_assets
+                         _initialGuess(initial_guess, num_assets),
                          args=args,
                          method='SLSQP',
+                         jac=portfolioVarianceGradient,
                          bounds=bounds,
                          constraints=constraints)
     return eff_opt
 
 
-def calculatedResults(mean_returns, cov_matrix, risk_free_rate, constraint_set):
-    """Compute all the results and the number of shares for each stock """
+@ins.instrumented
+def efficientFrontier(mean_returns, cov_matrix, target_returns, constraint_set, initial_guess=None):
+    """Trace the efficient frontier : the targets are solved in order, each one starting from the previous solution"""
+    results = []
+    weights = initial_guess
+    for target in target_returns:
+        result = efficientOptimization(mean_returns, cov_matrix, target, constraint_set, weights)
+        results.append(result)
+        weights = result['x']
+    return results
+
+
+@cachedResult
+@ins.instrumented
+def calculatedResults(mean_returns, cov_matrix, risk_free_rate, constraint_set, n_points=None, max_workers=None, executor=None, initial_guesses=None):
+    """Compute all the results and the number of shares for each stock.
+
+    n_points, max_workers and executor default to FRONTIER_POINTS, MAX_WORKERS and EXECUTOR.
+    initial_guesses (max Sharpe ratio weights, min volatility weights) warm-start the serial optimizations"""
+    import pandas as pd
+    n_points, max_workers, executor = _setting(n_points, 'n_points'), _setting(max_workers, 'max_workers'), _setting(executor, 'executor')
+
+    def targetReturns(max_SR_results, min_volatility_results):
+        return np.linspace(portfolioPerformance(min_volatility_results['x'], mean_returns, cov_matrix)[0],
+                           portfolioPerformance(max_SR_results['x'], mean_returns, cov_matrix)[0], n_points)
+
+    if max_workers is not None:
+        import parallel
+        with parallel.Pool(mean_returns, cov_matrix, max_workers, executor) as pool: # both stages run on the same workers
+            max_SR_results, min_volatility_results = pool.extremePortfolios(risk_free_rate, constraint_set)
+            target_returns = targetReturns(max_SR_results, min_volatility_results)
+            frontier = pool.efficientFrontier(target_returns, constraint_set, min_volatility_results['x'], max_SR_results['x'])
+    else:
+        max_SR_guess, min_volatility_guess = initial_guesses if initial_guesses is not None else (None, None)
+        max_SR_results = maximumSharpeRatio(mean_returns, cov_matrix, risk_free_rate, constraint_set, max_SR_guess)
+        min_volatility_results = minimumVariance(mean_returns, cov_matrix, constraint_set, min_volatility_guess)
+        target_returns = targetReturns(max_SR_results, min_volatility_results)
+        # the first target is the min volatility return, so its weights are the best starting point
+        frontier = efficientFrontier(mean_returns, cov_matrix, target_returns, constraint_set, min_volatility_results['x'])
+    efficient_list = [result['fun'] for result in frontier]
+
     #Max Sharpe ratio portfolio
-    max_SR_results = maximumSharpeRatio(mean_returns, cov_matrix, risk_free_rate, constraint_set)
     max_SR_returns, max_SR_std = portfolioPerformance(max_SR_results['x'], mean_returns, cov_matrix)
     max_SR_allocation = pd.DataFrame(max_SR_results['x'], index=mean_returns.index, columns=['allocation'])
     max_SR_allocation.allocation = [round(i*100,0) for i in max_SR_allocation.allocation]
 
     #MIn volatility portfolio
-    min_volatility_results = minimumVariance(mean_returns, cov_matrix, constraint_set)
     min_volatility_returns, min_volatility_std = portfolioPerformance(min_volatility_results['x'], mean_returns, cov_matrix)
     min_volatility_allocation = pd.DataFrame(min_volatility_results['x'], index=mean_returns.index, columns=['allocation'])
     min_volatility_allocation.allocation = [round(i*100,0) for i in min_volatility_allocation.allocation]
 
-    # Efficient frontier
-    efficient_list = []
-    target_returns = np.linspace(min_volatility_returns, max_SR_returns, 20)
-    
-    for target in target_returns:
-        efficient_list.append(efficientOptimization(mean_returns, cov_matrix, target, constraint_set)['fun'])
-        
     max_SR_returns, max_SR_std = round(max_SR_returns*100,2), round(max_SR_std*100,2)
     min_volatility_returns, min_volatility_std = round(min_volatility_returns*100,2), round(min_volatility_std*100,2)
     return max_SR_results, max_SR_returns, max_SR_std, max_SR_allocation, min_volatility_results, min_volatility_returns, min_volatility_std, min_volatility_allocation, efficient_list, target_returns
 
 
-def efficientFrontierGraph(mean_returns, cov_matrix, risk_free_rate, constraint_set):
-    """Return a graph of the efficient frontier"""
-    max_SR_results, max_SR_returns, max_SR_std, max_SR_allocation, min_volatility_results, min_volatility_returns, min_volatility_std, min_volatility_allocation, efficient_list, target_returns = calculatedResults(mean_returns, cov_matrix, risk_free_rate, constraint_set)
+def _capSimplex(weights, cap):
+    """Cap every row of weights (on the simplex) at cap (one number, or one per asset), the excess of the capped
+    weights going to the others in proportion"""
+    for i in range(weights.shape[1]): # every pass caps at least one more weight of the rows still above the cap
+        excess = np.maximum(weights - cap, 0).sum(axis=1, keepdims=True)
+        if not excess.any():
+            break
+        weights = np.minimum(weights, cap)
+        free = np.where(weights < cap, weights, 0)
+        weights = weights + free*excess/np.maximum(free.sum(axis=1, keepdims=True), 1e-300)
+    return np.minimum(weights, cap)
+
+
+@ins.instrumented
+def randomPortfolios(mean_returns, cov_matrix, risk_free_rate, constraint_set, n_portfolios=None, max_points=None, seed=None):
+    """Cloud of random portfolios within constraint_set, downsampled for plotting.
+
+    constraint_set is the same (lower, upper) for every asset, or one (lower, upper) per asset. The weights are
+    lower + (1 - sum(lower))*v, with v drawn uniformly on the simplex (Dirichlet) by chunks of
+    mc.CHUNK_ELEMENTS values and capped so that the weights stay below upper. The returns and volatilities of a chunk come from one batched product.
+    Only the best Sharpe ratio of every cell of a (volatility, return) grid is kept : the grid spans the range of
+    the first chunk (widened by CLOUD_MARGIN on each side), where random portfolios actually fall, and the later
+    portfolios outside of it go to the border cells.
+    Returns the annualised volatilities, returns and Sharpe ratios of at most max_points portfolios
+    (n_portfolios and max_points default to RANDOM_PORTFOLIOS and CLOUD_POINTS)."""
+    n_portfolios, max_points = _setting(n_portfolios, 'n_portfolios'), _setting(max_points, 'max_points')
+    mean_returns, cov_matrix = _asArrays(mean_returns, cov_matrix)
+    num_assets = len(mean_returns)
+    bounds = np.asarray(constraint_set, dtype=float)
+    if bounds.shape not in ((2,), (num_assets, 2)):
+        raise ValueError(f"constraint_set must be one (lower, upper) or {num_assets} of them, not an array of shape {bounds.shape}")
+    lower, upper = np.broadcast_to(bounds, (num_assets, 2)).T
+    if upper.sum() < 1 or lower.sum() > 1 or np.any(lower > upper):
+        raise ValueError(f"No portfolio of {num_assets} assets has its weights within {constraint_set}")
+    rng = np.random.default_rng(seed)
+    free_weight = 1 - lower.sum() # weight left above the lower bounds
+    cap = (upper - lower)/free_weight if free_weight > 0 else np.ones(num_assets)
+    side = max(1, int(np.sqrt(max_points)))
+    best = np.full(side*side, -np.inf) # best Sharpe ratio of every cell, and its portfolio
+    best_std, best_returns = np.zeros(side*side), np.zeros(side*side)
+
+    rows = max(1, mc.CHUNK_ELEMENTS//num_assets)
+    for first in range(0, n_portfolios, rows):
+        weights = rng.standard_exponential((min(rows, n_portfolios - first), num_assets))
+        weights /= weights.sum(axis=1, keepdims=True) # uniform on the simplex
+        above = np.any(weights > cap, axis=1)
+        if above.any():
+            weights[above] = _capSimplex(weights[above], cap)
+        weights = lower + free_weight*weights
+        returns = np.dot(weights, mean_returns)*N_TRADING_DAYS
+        std = np.sqrt(np.einsum('ij,ji->i', weights, cv.covDot(cov_matrix, weights.T))*N_TRADING_DAYS)
+        sharpe = (returns - risk_free_rate)/std
+
+        if first == 0:
+            edges = []
+            for values in (std, returns):
+                margin = CLOUD_MARGIN*(values.max() - values.min())
+                edges.append(np.linspace(values.min() - margin, values.max() + margin, side + 1)[1:-1])
+            std_edges, return_edges = edges
+        cells = np.searchsorted(return_edges, returns)*side + np.searchsorted(std_edges, std)
+        order = np.argsort(-sharpe, kind='stable')
+        chunk_cells, firsts = np.unique(cells[order], return_index=True) # best portfolio of the chunk in every cell
+        candidates = order[firsts]
+        better = sharpe[candidates] > best[chunk_cells]
+        chunk_cells, candidates = chunk_cells[better], candidates[better]
+        best[chunk_cells], best_std[chunk_cells], best_returns[chunk_cells] = sharpe[candidates], std[candidates], returns[candidates]
+    filled = np.isfinite(best)
+    return best_std[filled], best_returns[filled], best[filled]
+
+
+def cloudScatter(std, returns, sharpe):
+    """Plotly trace of a cloud of random portfolios (randomPortfolios), coloured by Sharpe ratio"""
+    import plotly.graph_objects as go
+    return go.Scattergl(
+        name='Random portfolios',
+        mode='markers',
+        x=np.round(std*100, 2),
+        y=np.round(returns*100, 2),
+        marker=dict(color=sharpe, colorscale='Viridis', size=5, colorbar=dict(title='Sharpe Ratio')))
+
+
+@ins.instrumented
+def efficientFrontierGraph(mean_returns, cov_matrix, risk_free_rate, constraint_set, n_portfolios=None, seed=None):
+    """Return a graph of the efficient frontier, over a cloud of n_portfolios (default RANDOM_PORTFOLIOS) random portfolios coloured by Sharpe ratio"""
+    n_portfolios = _setting(n_portfolios, 'n_portfolios')
+    calculated_results = calculatedResults(mean_returns, cov_matrix, risk_free_rate, constraint_set)
+    cloud = randomPortfolios(mean_returns, cov_matrix, risk_free_rate, constraint_set, n_portfolios, seed=seed) if n_portfolios else None
+    fig = efficientFrontierFigure(calculated_results, cloud)
+    return fig.show()
+
+
+def efficientFrontierFigure(calculated_results, cloud=None):
+    """Figure of the efficient frontier from the results of calculatedResults, over the cloud (std, returns, sharpe) of randomPortfolios"""
+    import plotly.graph_objects as go
+    max_SR_results, max_SR_returns, max_SR_std, max_SR_allocation, min_volatility_results, min_volatility_returns, min_volatility_std, min_volatility_allocation, efficient_list, target_returns = calculated_results
 
     #Max SR
     max_SR = go.Scatter(
@@ -180,6 +506,8 @@ def efficientFrontierGraph(mean_returns, cov_matrix, risk_free_rate, constraint_
         line=dict(color='black', width=4, dash='dashdot'))
 
     data = [max_SR, min_volatility, efficien_curve]
+    if cloud is not None:
+        data.insert(0, cloudScatter(*cloud))
 
     layout = go.Layout(
         title = 'Portfolio optimization with Efficient Frontier',
@@ -195,13 +523,14 @@ def efficientFrontierGraph(mean_returns, cov_matrix, risk_free_rate, constraint_
         width=800,
         height=600)
     
-    fig = go.Figure(data=data, layout=layout)
-    return fig.show()
+    return go.Figure(data=data, layout=layout)
 
 
-def resultsTable(mean_returns, cov_matrix, tickers, risk_free_rate, constraint_set):
+@ins.instrumented
+def resultsTable(mean_returns, cov_matrix, tickers, risk_free_rate, constraint_set, initial_guesses=None):
     """Display a table for the max SR and the min volatility with the returns, the volatility, SR and the allocation"""
-    max_SR_results, max_SR_returns, max_SR_std, max_SR_allocation, min_volatility_results, min_volatility_returns, min_volatility_std, min_volatility_allocation, efficient_list, target_returns = calculatedResults(mean_returns, cov_matrix, risk_free_rate, constraint_set)
+    import pandas as pd
+    max_SR_results, max_SR_returns, max_SR_std, max_SR_allocation, min_volatility_results, min_volatility_returns, min_volatility_std, min_volatility_allocation, efficient_list, target_returns = calculatedResults(mean_returns, cov_matrix, risk_free_rate, constraint_set, initial_guesses=initial_guesses)
     index = ['Maximum Sharpe Ratio', 'Minimum volatility']
     columns = ['Sharpe Ratio', 'Returns (%)', 'Voltatility (%)'] + tickers
     results = pd.DataFrame(columns=columns, index=index)
@@ -220,11 +549,13 @@ def resultsTable(mean_returns, cov_matrix, tickers, risk_free_rate, constraint_s
     return results
 
 
+@ins.instrumented
 def pieChart(results, tickers):
     """Display the pie charts of stocks allocations of the max SR and min volatility"""
+    import matplotlib.pyplot as plt
     labels = tickers
-    max_SR_sizes = results.loc['Maximum Sharpe Ratio', tickers]
-    min_vol_sizes = results.loc['Minimum volatility', tickers]
+    max_SR_sizes = results.loc['Maximum Sharpe Ratio', tickers].astype(float)
+    min_vol_sizes = results.loc['Minimum volatility', tickers].astype(float)
 
     fig1, ax1 = plt.subplots()
     ax1.pie(max_SR_sizes, labels=labels, autopct='%1.1f%%', startangle=90)
@@ -234,32 +565,184 @@ def pieChart(results, tickers):
     ax2.axis('equal')
     return fig1, fig2
 
-def parametricVar(returns, weights, confidence_level):
-    """Parametric VaR calculation"""
-    weighted_returns = np.dot(returns, weights)
-    weighted_returns = np.delete(weighted_returns, 0, 0) # delete 1st line
+def _portfolioReturns(returns, weights):
+    """Daily returns of the portfolio (weights can also hold one portfolio per column), without the 1st line"""
+    if isinstance(returns, rm.ReturnsMatrix): # no conversion of the returns, even when they are float32
+        return returns.portfolioReturns(np.asarray(weights, dtype=returns.values.dtype))
+    return np.dot(np.asarray(returns, dtype=float)[1:], weights) # 1st line of the returns is NaN
+
+@ins.instrumented
+def parametricVar(returns, weights, confidence_level, cov_matrix=None):
+    """Parametric VaR calculation (with the volatility of cov_matrix, dense or factor model, if given)"""
+    from scipy.stats import norm
+    weighted_returns = _portfolioReturns(returns, weights)
     mean = np.mean(weighted_returns)
-    std = np.std(weighted_returns)
+    std = np.std(weighted_returns) if cov_matrix is None else np.sqrt(np.dot(weights, cv.covDot(cov_matrix, weights)))
     var = norm.ppf(1 - confidence_level, mean, std) # include the z_score calculation
     return var
 
+@ins.instrumented
 def historicalVar(returns, weights, confidence_level):
     """Historical VaR calculation"""
-    weighted_returns = np.dot(returns, weights)
-    weighted_returns = np.delete(weighted_returns, 0, 0) # delete 1st line
+    weighted_returns = _portfolioReturns(returns, weights)
     # sorted_returns = np.sort(weighted_returns)
     # index = int((1-confidence_level)*len(sorted_returns))
     var = np.percentile(weighted_returns, 100 - confidence_level * 100) # equivalent to sort and choose index + allow interpolation if percentile is between 2 values
     return var
 
-def monteCarloVar(returns, weights, confidence_level, num_simulations, time_horizon):
-    """Monte Carlo VaR calculation"""
-    weighted_returns = np.dot(returns, weights)
-    weighted_returns = np.delete(weighted_returns, 0, 0) # delete 1st line
+@ins.instrumented
+def monteCarloVar(returns, weights, confidence_level, num_simulations, time_horizon, seed=None, dtype=np.float64, max_workers=None, standard_error=False):
+    """Monte Carlo VaR calculation (simulated by chunks, so the memory used does not depend on num_simulations).
+
+    With max_workers, the simulations are split over processes (see mc.parallelLogReturnSketches) : the VaR is
+    then the same for a given seed and max_workers. With standard_error, (VaR, standard error of the VaR) is returned"""
+    weighted_returns = _portfolioReturns(returns, weights)
     mean = np.mean(weighted_returns)
     std = np.std(weighted_returns)
-    simulations = np.random.normal(mean, std, size=(num_simulations, time_horizon))
-    portfolio_values = np.cumprod(1 + simulations, axis=1)
-    portfolio_returns = (portfolio_values[:, -1] - 1)
-    var = np.percentile(portfolio_returns, 100 - confidence_level * 100)
-    return var
\ No newline at end of file
+    sketch = _logReturnSketches(mean, std, time_horizon, num_simulations, seed, dtype, max_workers)[0][0]
+    var = mc.quantileReturn(sketch, 1 - confidence_level)
+    if standard_error:
+        return var, mc.quantileStandardError(sketch, 1 - confidence_level)
+    return var
+
+
+def _logReturnSketches(means, stds, time_horizons, num_simulations, seed, dtype, max_workers):
+    """Monte Carlo sketches on this process, or split over max_workers processes"""
+    if max_workers is not None:
+        return mc.parallelLogReturnSketches(means, stds, time_horizons, num_simulations, seed, max_workers, EXECUTOR, dtype)
+    return mc.logReturnSketches(means, stds, time_horizons, num_simulations, np.random.default_rng(seed), dtype)
+
+@ins.instrumented
+def varTable(returns, weights, confidence_levels, time_horizons, num_simulations=N_SIMULATIONS, names=None, seed=None, dtype=np.float64, simulator=None, max_workers=None):
+    """Parametric, historical and Monte Carlo VaR of several portfolios, confidence levels and time horizons at once.
+
+    weights holds one weights vector per portfolio. The parametric and historical VaR are scaled
+    to the horizon with the square root of time (a 1 day horizon gives parametricVar and historicalVar).
+    The Monte Carlo paths use the same standard normal draws for every portfolio. If a
+    montecarlo.MultiAssetSimulator is given, they are its correlated asset-level paths instead, else they can be
+    split over max_workers processes. The standard error of every Monte Carlo VaR is given next to it."""
+    from scipy.stats import norm
+    import pandas as pd
+    weights = np.atleast_2d(np.asarray(weights, dtype=float))
+    names = list(range(len(weights))) if names is None else list(names)
+    confidence_levels = np.asarray(confidence_levels, dtype=float)
+    time_horizons = np.asarray(time_horizons, dtype=int)
+    percentiles = 100 - confidence_levels * 100
+
+    weighted_returns = _portfolioReturns(returns, weights.T) # one column per portfolio
+    mean = np.mean(weighted_returns, axis=0)
+    std = np.std(weighted_returns, axis=0)
+    z_scores = norm.ppf(1 - confidence_levels)
+    historical = np.percentile(weighted_returns, percentiles, axis=0) # one partition per portfolio for every confidence level
+    if simulator is not None:
+        sketches = simulator.sketches(weights, time_horizons, num_simulations)
+    else:
+        sketches = _logReturnSketches(mean, std, time_horizons, num_simulations, seed, dtype, max_workers)
+
+    rows = []
+    for p, name in enumerate(names):
+        montecarlo = np.array([mc.quantileReturn(sketch, 1 - confidence_levels) for sketch in sketches[p]]).T
+        errors = np.array([mc.quantileStandardError(sketch, 1 - confidence_levels) for sketch in sketches[p]]).T
+        for c, confidence_level in enumerate(confidence_levels):
+            for h, time_horizon in enumerate(time_horizons):
+                scale = np.sqrt(time_horizon)
+                rows.append((name, confidence_level, time_horizon,
+                             mean[p]*time_horizon + z_scores[c]*std[p]*scale,
+                             historical[c, p]*scale,
+                             montecarlo[c, h],
+                             errors[c, h]))
+    table = pd.DataFrame(rows, columns=['Portfolio', 'Confidence level', 'Time horizon', 'Parametric VaR', 'Historical VaR', 'Monte Carlo VaR', 'Monte Carlo standard error'])
+    return table.set_index(['Portfolio', 'Confidence level', 'Time horizon'])
+
+
+class OrderStatistics:
+    """Sliding window over a series of values, kept as Fenwick trees of counts and sums indexed by the rank of each value.
+
+    Adding or removing a day, the k-th smallest value of the window and the sum of its k smallest values cost O(log n)."""
+
+    def __init__(self, values):
+        values = np.asarray(values, dtype=float)
+        order = np.argsort(values, kind='stable')
+        ranks = np.empty(len(values), dtype=int)
+        ranks[order] = np.arange(len(values)) # every day has its own rank, even for equal values
+        self.sorted = values[order].tolist()
+        self.ranks = ranks.tolist()
+        self.size = len(values)
+        self.counts = [0]*(self.size + 1)
+        self.sums = [0.]*(self.size + 1)
+        self.step = 1 << (self.size.bit_length() - 1) if self.size else 0
+        self.count = 0
+
+    def _update(self, rank, count):
+        value = self.sorted[rank]*count
+        i = rank + 1
+        while i <= self.size:
+            self.counts[i] += count
+            self.sums[i] += value
+            i += i & -i
+
+    def add(self, day):
+        self._update(self.ranks[day], 1)
+        self.count += 1
+
+    def remove(self, day):
+        self._update(self.ranks[day], -1)
+        self.count -= 1
+
+    def smallest(self, k):
+        """k-th smallest value of the window (k starts at 1) and sum of the k smallest values"""
+        position, total, remaining, step = 0, 0., k, self.step
+        while step:
+            following = position + step
+            if following <= self.size and self.counts[following] < remaining:
+                position = following
+                remaining -= self.counts[following]
+                total += self.sums[following]
+            step >>= 1
+        value = self.sorted[position]
+        return value, total + value
+
+@ins.instrumented
+def rollingVar(returns, weights, confidence_levels, window=N_TRADING_DAYS, names=None):
+    """Historical VaR and Expected Shortfall of several portfolios over a sliding window of days.
+
+    Every day enters and leaves an OrderStatistics once, and all the confidence levels are read from it on the same pass.
+    The VaR is the percentile of the window (same interpolation as historicalVar), the ES is the mean of the
+    ceil((1 - confidence level)*window) worst returns. Returns a DataFrame indexed by the last day of each window,
+    with (Portfolio, 'VaR' or 'ES', confidence level) columns."""
+    import pandas as pd
+    weights = np.atleast_2d(np.asarray(weights, dtype=float))
+    names = list(range(len(weights))) if names is None else list(names)
+    confidence_levels = list(confidence_levels)
+    weighted_returns = _portfolioReturns(returns, weights.T)
+    n_days = len(weighted_returns)
+    if n_days < window:
+        raise ValueError(f"{n_days} days of returns, at least the window ({window} days) are needed")
+    positions = [(1 - confidence_level)*(window - 1) for confidence_level in confidence_levels]
+    tail_sizes = [max(1, int(np.ceil((1 - confidence_level)*window - 1e-9))) for confidence_level in confidence_levels]
+
+    columns, series = [], []
+    for p, name in enumerate(names):
+        statistics = OrderStatistics(weighted_returns[:, p])
+        var = np.empty((n_days - window + 1, len(confidence_levels)))
+        es = np.empty_like(var)
+        for day in range(n_days):
+            statistics.add(day)
+            if day >= window:
+                statistics.remove(day - window)
+            if day < window - 1:
+                continue
+            row = day - window + 1
+            for c, (position, tail_size) in enumerate(zip(positions, tail_sizes)):
+                lower = int(position)
+                low_value = statistics.smallest(lower + 1)[0]
+                high_value = statistics.smallest(lower + 2)[0] if position > lower else low_value
+                var[row, c] = low_value + (position - lower)*(high_value - low_value)
+                es[row, c] = statistics.smallest(tail_size)[1]/tail_size
+        for measure, values in (('VaR', var), ('ES', es)):
+            for c, confidence_level in enumerate(confidence_levels):
+                columns.append((name, measure, confidence_level))
+                series.append(values[:, c])
+    index = returns.index[1:][window - 1:] if hasattr(returns, 'index') else np.arange(window, n_days + 1)
+    return pd.DataFrame(np.column_stack(series), index=index,
+                        columns=pd.MultiIndex.from_tuples(columns, names=['Portfolio', 'Measure', 'Confidence level']))
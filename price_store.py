@@ -0,0 +1,329 @@
+##############################
+#          Libraries         #
+##############################
+
+import os
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import instrumentation as ins
+
+
+##############################
+#         Parameters         #
+##############################
+
+PRICE_DTYPE = np.dtype([('date', 'datetime64[D]'), ('close', 'float64')])
+INDEX_FILE = 'index.json'
+CHUNK_SIZE = 20 # tickers per request of a ChunkedSource
+FETCH_WORKERS = 4 # concurrent requests of a ChunkedSource (for the sources that are thread safe)
+RETRIES = 3 # new attempts of a failed request
+BACKOFF = 1. # seconds before the 1st new attempt, doubled at each one
+RESCALE_TOLERANCE = 1e-6 # relative change of a stored price above which the stored history is rescaled
+HOLIDAY_DAYS = 1 # business days of a request that may come back empty for every ticker without being a failure
+NO_DATA_TTL = 3600. # seconds during which tickers that came back empty after every retry are not retried again
+
+
+##############################
+#           Sources          #
+##############################
+
+def toDay(date):
+    """Convert any date-like value (str, date, datetime, Timestamp) to a numpy day"""
+    return np.datetime64(pd.Timestamp(date).date(), 'D')
+
+
+class FetchError(Exception):
+    """A request came back without any data (tickers : the tickers to ask again, data : the prices received)"""
+
+    def __init__(self, tickers, data):
+        super().__init__(f'no data for {", ".join(tickers)}')
+        self.tickers = list(tickers)
+        self.data = data
+
+
+class YahooSource:
+    """Download adjusted close prices from Yahoo Finance"""
+
+    thread_safe = False # yf.download keeps its results in module globals, concurrent calls could mix them
+
+    def fetch(self, tickers, start, end):
+        """Return a DataFrame of prices (one column per ticker) between start (included) and end (excluded).
+
+        yf.download does not raise when a download fails, it returns empty or NaN columns. When other tickers of the
+        request have prices, the empty ones have no data (e.g. delisted) and are returned as empty columns. When
+        every ticker is empty over more than HOLIDAY_DAYS business days, the request failed : FetchError is raised"""
+        import yfinance as yf
+        data = yf.download(list(tickers), str(start), str(end), auto_adjust=False, progress=False)['Adj Close']
+        if isinstance(data, pd.Series):
+            data = data.to_frame(tickers[0])
+        data = data.reindex(columns=list(tickers))
+        if data.isna().all().all() and np.busday_count(toDay(start), toDay(end)) > HOLIDAY_DAYS:
+            raise FetchError(tickers, data.iloc[:0, :0])
+        return data
+
+
+class CsvSource:
+    """Read adjusted close prices from a local CSV file (dates in the first column, one column per ticker)"""
+
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+
+    def fetch(self, tickers, start, end):
+        """Return a DataFrame of prices (one column per ticker) between start (included) and end (excluded).
+
+        A ticker absent from the file gets an empty column : it has no data, it is not a failed request"""
+        if self.data is None:
+            self.data = pd.read_csv(self.path, index_col=0, parse_dates=True).sort_index()
+        dates = self.data.index.values.astype('datetime64[D]')
+        rows = (dates >= start) & (dates < end)
+        return self.data.loc[rows].reindex(columns=list(tickers))
+
+
+class FolderSource:
+    """Read the adjusted close prices of every ticker from <location>/<ticker>.csv (dates in the first column,
+    prices in the last one). location is a local folder, or the URL of a server such as python -m http.server"""
+
+    thread_safe = True
+
+    def __init__(self, location):
+        self.location = location.rstrip('/')
+
+    def _read(self, ticker):
+        from urllib.error import HTTPError
+        try:
+            data = pd.read_csv(f'{self.location}/{ticker}.csv', index_col=0, parse_dates=True)
+        except FileNotFoundError:
+            return None
+        except HTTPError as error:
+            if error.code == 404:
+                return None
+            raise # other HTTP errors may be transient : let the caller retry
+        return data.iloc[:, -1].sort_index()
+
+    def fetch(self, tickers, start, end):
+        """Return a DataFrame of prices (one column per ticker) between start (included) and end (excluded).
+
+        A ticker without any file gets an empty column : it has no data, it is not a failed request"""
+        data = {}
+        for ticker in tickers:
+            prices = self._read(ticker)
+            if prices is not None:
+                dates = prices.index.values.astype('datetime64[D]')
+                data[ticker] = prices[(dates >= start) & (dates < end)]
+        return pd.DataFrame(data, columns=list(tickers))
+
+
+class ChunkedSource:
+    """Wrap a source : split the tickers into chunks of chunk_size, fetch the chunks on max_workers threads
+    (one at a time if the source is not thread_safe) and retry a failed chunk with an exponential backoff.
+
+    stream() yields each chunk as soon as it lands, so that it can be stored or processed while the others download."""
+
+    def __init__(self, source, chunk_size=CHUNK_SIZE, max_workers=FETCH_WORKERS, retries=RETRIES, backoff=BACKOFF):
+        self.source = source
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers if getattr(source, 'thread_safe', False) else 1
+        self.retries = retries
+        self.backoff = backoff
+        self.empty = {} # ticker -> time at which it came back without data after every retry
+
+    def _fetchChunk(self, tickers, start, end):
+        """Fetch a chunk, retrying a failed request, or only the tickers of a FetchError.
+
+        The tickers still missing after the last attempt are left out of the result (so they are not covered).
+        They are then asked only once (without retries) for NO_DATA_TTL seconds : a ticker queried alone which
+        has no data at all (e.g. delisted) cannot be told from a failed request, but does not wait again"""
+        now = time.time()
+        retries = 0 if all(now - self.empty.get(ticker, -np.inf) < NO_DATA_TTL for ticker in tickers) else self.retries
+        frames = []
+        for attempt in range(retries + 1):
+            try:
+                frames.append(self.source.fetch(tickers, start, end))
+                break
+            except FetchError as error:
+                frames.append(error.data)
+                tickers = error.tickers
+                if attempt == retries:
+                    self.empty.update(dict.fromkeys(tickers, time.time()))
+                    break
+            except Exception:
+                if attempt == retries:
+                    raise
+            time.sleep(self.backoff*2**attempt)
+        return frames[0] if len(frames) == 1 else pd.concat(frames, axis=1)
+
+    def stream(self, tickers, start, end):
+        """Yield (chunk tickers, DataFrame of their prices) in the order the chunks land"""
+        tickers = list(tickers)
+        chunks = [tickers[i:i + self.chunk_size] for i in range(0, len(tickers), self.chunk_size)]
+        if self.max_workers <= 1 or len(chunks) == 1:
+            for chunk in chunks:
+                yield chunk, self._fetchChunk(chunk, start, end)
+            return
+        with ThreadPoolExecutor(min(self.max_workers, len(chunks))) as executor:
+            futures = {executor.submit(self._fetchChunk, chunk, start, end): chunk for chunk in chunks}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+    def fetch(self, tickers, start, end):
+        """Return a DataFrame of prices (one column per ticker) between start (included) and end (excluded)"""
+        frames = [data for chunk, data in self.stream(tickers, start, end)]
+        data = pd.concat(frames, axis=1) if frames else pd.DataFrame()
+        return data.reindex(columns=[ticker for ticker in tickers if ticker in data.columns])
+
+
+##############################
+#            Store           #
+##############################
+
+class PriceStore:
+    """On-disk price store : one memory-mapped .npy file of (date, close) per ticker.
+
+    Only the date ranges that have never been fetched are requested from the source,
+    and they are appended to the ticker file. Repeated queries are served from the
+    memory-mapped files without any network access or parsing."""
+
+    def __init__(self, root, source=None):
+        self.root = root
+        self.source = source if source is not None else YahooSource()
+        self.arrays = {} # ticker -> memory-mapped array, kept open between queries
+        self.coverage = None # ticker -> (first day fetched, last day fetched + 1)
+
+    def _path(self, ticker):
+        return os.path.join(self.root, ticker.replace('/', '_') + '.npy')
+
+    def _loadCoverage(self):
+        if self.coverage is None:
+            self.coverage = {}
+            path = os.path.join(self.root, INDEX_FILE)
+            if os.path.exists(path):
+                with open(path) as file:
+                    for ticker, (start, end) in json.load(file).items():
+                        self.coverage[ticker] = (np.datetime64(start, 'D'), np.datetime64(end, 'D'))
+        return self.coverage
+
+    def _saveCoverage(self):
+        path = os.path.join(self.root, INDEX_FILE)
+        with open(path + '.tmp', 'w') as file:
+            json.dump({ticker: [str(start), str(end)] for ticker, (start, end) in self.coverage.items()}, file, indent=1)
+        os.replace(path + '.tmp', path)
+
+    def _load(self, ticker):
+        """Get the stored prices of a ticker (memory-mapped, sorted by date)"""
+        if ticker not in self.arrays:
+            path = self._path(ticker)
+            if os.path.exists(path):
+                self.arrays[ticker] = np.load(path, mmap_mode='r')
+            else:
+                self.arrays[ticker] = np.empty(0, dtype=PRICE_DTYPE)
+        return self.arrays[ticker]
+
+    def missingRanges(self, ticker, start, end):
+        """Return the list of (start, end) ranges of [start, end) which were never fetched"""
+        coverage = self._loadCoverage()
+        if ticker not in coverage:
+            return [(start, end)]
+        covered_start, covered_end = coverage[ticker]
+        ranges = []
+        if start < covered_start:
+            ranges.append((start, covered_start)) # also fills any gap, so the covered range stays contiguous
+        if end > covered_end:
+            ranges.append((max(covered_end, start), end))
+        return ranges
+
+    def _withOverlap(self, ticker, start, end):
+        """Widen a missing range to the stored day next to it, so that the source sends that day again (see _append)"""
+        array = self._load(ticker)
+        if len(array):
+            if start > array['date'][-1]:
+                start = array['date'][-1]
+            if end <= array['date'][0]:
+                end = array['date'][0] + 1
+        return start, end
+
+    def _append(self, ticker, prices, start, end):
+        """Merge new (date, close) rows into the ticker file and extend its covered range.
+
+        Adjusted prices (such as the Adj Close of Yahoo) are rescaled backwards by the source after every split
+        or dividend, so prices fetched at different times are on different scales. When a day is both stored
+        and fetched again (update always asks for one stored day), the stored history is rescaled by the ratio
+        of the new price to the stored one, so that there is no jump where the old and new prices meet."""
+        prices = prices.dropna()
+        new = np.empty(len(prices), dtype=PRICE_DTYPE)
+        new['date'] = prices.index.values.astype('datetime64[D]')
+        new['close'] = prices.values
+        stored = np.array(self._load(ticker))
+        common, stored_rows, new_rows = np.intersect1d(stored['date'], new['date'], return_indices=True)
+        if len(common):
+            ratio = new['close'][new_rows[-1]]/stored['close'][stored_rows[-1]]
+            if np.isfinite(ratio) and ratio > 0 and abs(ratio - 1) > RESCALE_TOLERANCE:
+                stored['close'] *= ratio
+        merged = np.concatenate([stored, new])
+        merged = merged[np.argsort(merged['date'], kind='stable')]
+        keep = np.ones(len(merged), dtype=bool)
+        keep[:-1] = merged['date'][1:] != merged['date'][:-1] # keep the last fetched value of a duplicated day
+        self.arrays.pop(ticker, None)
+        path = self._path(ticker)
+        np.save(path + '.tmp.npy', merged[keep])
+        os.replace(path + '.tmp.npy', path)
+
+        coverage = self._loadCoverage()
+        if ticker in coverage:
+            start, end = min(start, coverage[ticker][0]), max(end, coverage[ticker][1])
+        coverage[ticker] = (start, end)
+
+    def _stream(self, tickers, start, end):
+        """Chunks of (tickers, prices) of the source : streamed by a ChunkedSource, or a single one"""
+        if hasattr(self.source, 'stream'):
+            yield from self.source.stream(tickers, start, end)
+        else:
+            try:
+                yield tickers, self.source.fetch(tickers, start, end)
+            except FetchError as error:
+                yield tickers, error.data # the tickers without data are not covered, the next query asks again
+
+    def update(self, tickers, start, end, on_chunk=None):
+        """Fetch and store every missing range of the tickers between start and end.
+
+        Each chunk is stored as soon as it lands (the chunks already stored are kept if a later one fails),
+        then on_chunk(chunk tickers) is called. A ticker is marked as covered only if the source returned its
+        column (possibly without any price, e.g. a holiday) : a ticker left out is asked again by the next query.
+        Nothing is fetched (nor covered) from today on : the prices of today are not final yet, and later days
+        will be fetched by the queries made after them."""
+        end = min(end, toDay(pd.Timestamp.now()))
+        requests = {} # missing range (with its stored day) -> tickers, so that tickers sharing a range are fetched together
+        for ticker in tickers:
+            for missing in self.missingRanges(ticker, start, end):
+                requests.setdefault(self._withOverlap(ticker, *missing), []).append(ticker)
+        if not requests:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        for (range_start, range_end), range_tickers in requests.items():
+            with ins.stage(f'download ({type(self.source).__name__})'):
+                for chunk, data in self._stream(range_tickers, range_start, range_end):
+                    for ticker in chunk:
+                        if ticker in data.columns:
+                            self._append(ticker, data[ticker], range_start, range_end)
+                    self._saveCoverage()
+                    if on_chunk is not None:
+                        on_chunk(chunk)
+
+    def _prices(self, tickers, start, end):
+        """DataFrame of the stored prices of the tickers, on the union of their dates"""
+        prices = {}
+        for ticker in tickers:
+            array = self._load(ticker)
+            first, last = np.searchsorted(array['date'], [start, end])
+            rows = array[first:last]
+            prices[ticker] = pd.Series(rows['close'], index=pd.DatetimeIndex(rows['date'].astype('datetime64[ns]')))
+        return pd.DataFrame(prices, columns=list(tickers))
+
+    def getPrices(self, tickers, start, end):
+        """Return a DataFrame of prices (one column per ticker) between start (included) and end (excluded)"""
+        start, end = toDay(start), toDay(end)
+        self.update(tickers, start, end)
+        return self._prices(tickers, start, end)
@@ -0,0 +1,121 @@
+##############################
+#          Libraries         #
+##############################
+
+import numpy as np
+
+
+##############################
+#       Returns matrix       #
+##############################
+
+class ReturnsMatrix:
+    """Daily returns as one contiguous (days x tickers) ndarray, with its ticker and date indexes and its NaN mask.
+
+    It answers the part of the DataFrame interface that the optimizers, the covariance estimators, the VaR
+    functions and the backtest use (values, index, columns, dropna, mean, cov), and np.asarray of it is
+    the array itself, so the hot loops never go through pandas. Slicing by dates (between) and by a
+    regular range of tickers (select) returns views, without copying the returns."""
+
+    def __init__(self, values, tickers, dates, mask=None):
+        values = np.asarray(values)
+        self.values = values if values.dtype in (np.float32, np.float64) else values.astype(np.float64) # views are kept as they are
+        self.tickers = list(tickers)
+        self.dates = np.asarray(dates, dtype='datetime64[ns]')
+        self.mask = np.isnan(self.values) if mask is None else mask # True where a return is missing
+
+    @classmethod
+    def fromFrame(cls, returns, dtype=np.float64):
+        """ReturnsMatrix of a DataFrame of returns (such as getAllReturns), stored as float64 or float32"""
+        return cls(np.ascontiguousarray(returns.values, dtype=dtype), returns.columns, returns.index.values)
+
+    def toFrame(self):
+        import pandas as pd
+        return pd.DataFrame(self.values, index=pd.DatetimeIndex(self.dates), columns=self.tickers)
+
+    @property
+    def index(self):
+        return self.dates
+
+    @property
+    def columns(self):
+        return self.tickers
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def __len__(self):
+        return len(self.values)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.values if dtype is None else self.values.astype(dtype, copy=False)
+
+    def __getstate__(self):
+        return {'values': np.ascontiguousarray(self.values), 'tickers': self.tickers, 'dates': self.dates} # the mask is rebuilt when loaded
+
+    def __setstate__(self, state):
+        self.__init__(state['values'], state['tickers'], state['dates'])
+
+    def _rows(self, rows):
+        return ReturnsMatrix(self.values[rows], self.tickers, self.dates[rows], self.mask[rows])
+
+    def between(self, start=None, end=None):
+        """Days from start (included) to end (excluded), as a view"""
+        first = 0 if start is None else np.searchsorted(self.dates, np.datetime64(start, 'ns'))
+        last = len(self.dates) if end is None else np.searchsorted(self.dates, np.datetime64(end, 'ns'))
+        return self._rows(slice(first, last))
+
+    def select(self, tickers):
+        """Columns of the tickers (in their order) : a view if they are evenly spaced in the matrix, else a copy"""
+        positions = np.array([self.tickers.index(ticker) for ticker in tickers], dtype=int)
+        steps = np.diff(positions)
+        if len(positions) and (len(steps) == 0 or (steps[0] > 0 and np.all(steps == steps[0]))):
+            step = steps[0] if len(steps) else 1
+            columns = slice(positions[0], positions[-1] + 1, step)
+        else:
+            columns = positions
+        return ReturnsMatrix(self.values[:, columns], list(tickers), self.dates, self.mask[:, columns])
+
+    def dropna(self):
+        """Days without any missing return : a view when they are consecutive (such as every day but the 1st)"""
+        complete = np.flatnonzero(~self.mask.any(axis=1))
+        if len(complete) == 0 or complete[-1] - complete[0] + 1 == len(complete):
+            return self._rows(slice(complete[0], complete[-1] + 1) if len(complete) else slice(0, 0))
+        return self._rows(complete)
+
+    def meanArray(self, columns=None):
+        """Mean return of every ticker (or of the column positions given), over its available days"""
+        values, mask = (self.values, self.mask) if columns is None else (self.values[:, columns], self.mask[:, columns])
+        counts = np.sum(~mask, axis=0)
+        return np.where(mask, 0, values).sum(axis=0, dtype=np.float64)/np.maximum(counts, 1)
+
+    def covArray(self, columns=None):
+        """Sample covariance over the pairwise complete days (same as DataFrame.cov), in 3 matrix products.
+
+        With column positions, only the (tickers x columns) block is computed, e.g. for the tickers just added."""
+        valid = (~self.mask).astype(np.float64)
+        values = np.where(self.mask, 0, self.values).astype(np.float64, copy=False)
+        other_valid, other_values = (valid, values) if columns is None else (valid[:, columns], values[:, columns])
+        counts = np.dot(valid.T, other_valid) # days where both returns exist
+        sums = np.dot(values.T, other_valid) # [i, j] : sum of the returns of i over the days where j also exists
+        other_sums = np.dot(valid.T, other_values) # [i, j] : sum of the returns of j over the days where i also exists
+        products = np.dot(values.T, other_values)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cov = (products - sums*other_sums/counts)/(counts - 1)
+        cov[counts < 2] = np.nan
+        return cov
+
+    def mean(self):
+        """Labelled mean returns (a Series, as DataFrame.mean)"""
+        import pandas as pd
+        return pd.Series(self.meanArray(), index=self.tickers)
+
+    def cov(self):
+        """Labelled covariance (a DataFrame, as DataFrame.cov)"""
+        import pandas as pd
+        return pd.DataFrame(self.covArray(), index=self.tickers, columns=self.tickers)
+
+    def portfolioReturns(self, weights, skip=1):
+        """Daily returns of one portfolio (or one per column of weights), without the first skip days"""
+        return np.dot(self.values[skip:], weights)